@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+"""Synthetic benchmark for discovery, parsing and downloading.
+
+Builds a fake dump (new and/or old hierarchy), serves the referenced
+photos from a local aiohttp server and measures every stage in a separate
+process, so the peak RSS of one stage does not hide the others.
+
+    python3 benchmarks/benchmark.py --dialogs 200 --messages 500 \
+        --latency 0.05 --error-rate 0.01 --json results.json
+"""
+
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from vk_dump_extractor.dialog_extractor import (  # noqa: E402
+    DefaultDirNames, Downloader, Extractor, RetryPolicy)
+
+OLD_DIALOG_DIR = 'parni', 'telki'
+OLD_ATTACHMENT_DIR = 'all_images'
+OLD_PHOTO_FILE = 'images.htm'
+STAGES = ('discovery', 'parse', 'download', 'end-to-end')
+
+
+class Layout:
+    def __init__(self, name, chat_dir, attachment_dir, boys_dir, girls_dir,
+                 photo_file, dialog_ext):
+        self.name = name
+        self.chat_dir = chat_dir
+        self.attachment_dir = attachment_dir
+        self.boys_dir = boys_dir
+        self.girls_dir = girls_dir
+        self.photo_file = photo_file
+        self.dialog_ext = dialog_ext
+
+    @property
+    def is_htm(self):
+        return self.dialog_ext == 'htm'
+
+    def extractor_options(self):
+        return dict(include_chat_with_girls=True,
+                    include_chat_with_boys=True,
+                    include_attachment_girls=True,
+                    include_attachment_boys=True,
+                    attachment_path_name=self.attachment_dir,
+                    chat_path_name=self.chat_dir,
+                    girls_dir=self.girls_dir,
+                    boys_dir=self.boys_dir,
+                    photo_file_name=self.photo_file)
+
+
+LAYOUTS = {
+    'new':
+    Layout('new', DefaultDirNames.CHAT_PATH_NAME.value,
+           DefaultDirNames.ATTACHMENT_PATH_NAME.value,
+           DefaultDirNames.BOYS_DIR.value, DefaultDirNames.GIRLS_DIR.value,
+           'photos.html', 'html'),
+    'old':
+    Layout('old', '.', OLD_ATTACHMENT_DIR, *OLD_DIALOG_DIR, OLD_PHOTO_FILE,
+           'htm'),
+}
+
+
+def _message(layout, base_url, author, date, urls):
+    if layout.is_htm:
+        links = ''.join(f'<a href="{url}">photo</a>' for url in urls)
+        return (f'<tr class="im_in"><td>'
+                f'<div class="im_log_author_chat_name">{author}</div>'
+                f'<a class="im_date_link" href="{base_url}">{date}</a>'
+                f'</td><td>{links}</td></tr>\n')
+    links = ''.join(f'<a class="download_photo_type" href="{url}">photo</a>'
+                    for url in urls)
+    return (f'<div class="im_in"><div class="im_log_author_chat_name">'
+            f'{author}</div><a class="im_date_link" href="{base_url}">'
+            f'{date}</a><div class="im_text">Lorem ipsum dolor sit amet, '
+            f'consectetur adipiscing elit.</div>{links}</div>\n'
+            f'<div class="im_out"><div class="im_text">Reply</div></div>\n')
+
+
+def generate_dump(root, layout, base_url, dialogs, messages,
+                  photos_per_message):
+    """Write a fake dump, returns the number of photo links in dialogs."""
+    dialog_root = root if layout.chat_dir == '.' else os.path.join(
+        root, layout.chat_dir)
+    link_count = 0
+    for sex_dir in (layout.boys_dir, layout.girls_dir):
+        dialog_dir = os.path.join(dialog_root, sex_dir)
+        attachment_dir = os.path.join(root, layout.attachment_dir, sex_dir)
+        os.makedirs(dialog_dir, exist_ok=True)
+        os.makedirs(attachment_dir, exist_ok=True)
+        attachment_urls = []
+        for dialog in range(dialogs):
+            file_name = f'history_{dialog}.{layout.dialog_ext}'
+            with open(os.path.join(dialog_dir, file_name),
+                      'w',
+                      encoding='utf-8') as file:
+                file.write('<html><head><title>Диалог</title></head><body>'
+                           '<table>\n' if layout.is_htm else
+                           '<html><head><title>Диалог</title></head><body>\n')
+                for message in range(messages):
+                    urls = [
+                        f'{base_url}/{sex_dir}/{dialog}/{message}_{photo}.jpg'
+                        f'?size=604x453&quality=96'
+                        for photo in range(photos_per_message)
+                    ]
+                    attachment_urls.extend(urls)
+                    date = (f'{1 + message % 28:02}.{1 + message % 12:02}.'
+                            f'2020 {message % 24:02}:{message % 60:02}')
+                    file.write(
+                        _message(layout, base_url, f'Author {dialog}', date,
+                                 urls))
+                    link_count += len(urls)
+                file.write('</table></body></html>' if layout.is_htm else
+                           '</body></html>')
+        with open(os.path.join(attachment_dir, layout.photo_file),
+                  'w',
+                  encoding='utf-8') as file:
+            file.write('<html><head><title>Общий лист фотографий</title>'
+                       '</head><body>\n')
+            for url in attachment_urls:
+                file.write(f'<div><a class="download_photo_type" '
+                           f'href="{url}">photo</a></div>\n')
+            file.write('</body></html>')
+    return link_count
+
+
+class ImageServer:
+    """Local stand-in for the CDN with latency, errors and given sizes."""
+    def __init__(self, latency, error_rate, image_size):
+        self._latency = latency
+        self._error_rate = error_rate
+        self._body = (b'\xff\xd8' + os.urandom(max(image_size - 4, 0)) +
+                      b'\xff\xd9')
+        self._loop = asyncio.new_event_loop()
+        self._runner = None
+        self.port = None
+
+    async def _handle(self, request):
+        if self._latency:
+            await asyncio.sleep(random.expovariate(1 / self._latency))
+        if random.random() < self._error_rate:
+            return web.Response(status=503, headers={'Retry-After': '0'})
+        body = self._body
+        range_header = request.headers.get('Range', '')
+        if range_header.startswith('bytes='):
+            start = int(range_header[6:].split('-')[0])
+            return web.Response(status=206,
+                                body=body[start:],
+                                content_type='image/jpeg')
+        return web.Response(body=body, content_type='image/jpeg')
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_get('/{tail:.*}', self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    def start(self):
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._start())
+            started.set()
+            self._loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        started.wait()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(),
+                                         self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+def _peak_rss_mib():
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+
+def _remove_photo_dirs(root):
+    for dir_path, dir_names, _ in os.walk(root):
+        if 'photo' in dir_names:
+            shutil.rmtree(os.path.join(dir_path, 'photo'))
+            dir_names.remove('photo')
+
+
+def _html_size(files):
+    return sum(os.path.getsize(file.file_path) for file in files)
+
+
+def _new_extractor(options, layout):
+    return Extractor(options.thread_count,
+                     parse_workers=options.parse_workers,
+                     retry_policy=RetryPolicy(options.retries, 0.05, 1),
+                     streaming_parse=options.streaming_parse,
+                     **layout.extractor_options())
+
+
+def _bench_discovery(options, layout, root):
+    extractor = _new_extractor(options, layout)
+    started = time.perf_counter()
+    files = extractor.get_files(root, False)
+    return {'seconds': time.perf_counter() - started, 'files': len(files)}
+
+
+def _bench_parse(options, layout, root):
+    extractor = _new_extractor(options, layout)
+    files = extractor.get_files(root, False)
+    started = time.perf_counter()
+    records = [
+        record for _, file_records in extractor.iter_parsed_records(files)
+        for record in file_records
+    ]
+    seconds = time.perf_counter() - started
+    # old .htm messages give their date links too, count only photo links
+    is_photo = Downloader._link_validator  # pylint: disable=protected-access
+    links = sum(is_photo(record.url) for record in records)
+    messages = 2 * options.dialogs * options.messages  # boys and girls
+    size = _html_size(files)
+    return {
+        'seconds': seconds,
+        'messages': messages,
+        'messages_per_second': messages / seconds,
+        'links': links,
+        'links_per_second': links / seconds,
+        'mib_per_second': size / 1024 / 1024 / seconds,
+    }
+
+
+def _image_counts(downloader: Downloader):
+    """(jobs run, downloaded images) from the run counters.
+
+    ``total_count`` stays 0 in pipelined mode, the counters do not.
+    """
+    counters = downloader.metrics.counters
+    downloaded = counters['downloaded']
+    return downloaded + counters['skipped'] + counters['error'], downloaded
+
+
+async def _timed_download(downloader: Downloader, coroutine):
+    started = time.perf_counter()
+    await coroutine
+    seconds = time.perf_counter() - started
+    downloaded_bytes = sum(stats.bytes
+                           for stats in downloader.host_stats.values())
+    images, downloaded = _image_counts(downloader)
+    return {
+        'seconds': seconds,
+        'images': images,
+        'downloaded': downloaded,
+        'downloaded_per_second': downloaded / seconds,
+        'mib_per_second': downloaded_bytes / 1024 / 1024 / seconds,
+    }
+
+
+def _bench_download(options, layout, root):
+    _remove_photo_dirs(root)
+    extractor = _new_extractor(options, layout)
+    extractor.collect_images(extractor.get_files(root, False))
+    downloader = extractor.downloader
+    return asyncio.run(_timed_download(downloader,
+                                       downloader.download_files()))
+
+
+def _bench_end_to_end(options, layout, root):
+    _remove_photo_dirs(root)
+
+    async def run():
+        extractor = _new_extractor(options, layout)
+        started = time.perf_counter()
+        dumps = {root: extractor.get_files(root, False)}
+        await extractor.download_from_dumps(dumps, options.pipeline)
+        seconds = time.perf_counter() - started
+        images, downloaded = _image_counts(extractor.downloader)
+        return {
+            'seconds': seconds,
+            'images': images,
+            'downloaded': downloaded,
+            'downloaded_per_second': downloaded / seconds,
+        }
+
+    return asyncio.run(run())
+
+
+BENCHMARKS = {
+    'discovery': _bench_discovery,
+    'parse': _bench_parse,
+    'download': _bench_download,
+    'end-to-end': _bench_end_to_end,
+}
+
+
+def _run_stage(stage, options, layout_name, root, results):
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, \
+            contextlib.redirect_stdout(devnull), \
+            contextlib.redirect_stderr(devnull):
+        result = BENCHMARKS[stage](options, LAYOUTS[layout_name], root)
+    result['peak_rss_mib'] = _peak_rss_mib()
+    results.put(result)
+
+
+def run_stage(stage, options, layout_name, root):
+    """Run one stage in a fresh process for an honest peak RSS."""
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_run_stage,
+                              args=(stage, options, layout_name, root,
+                                    results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def _format(result):
+    return ', '.join(f'{key}: {value:.2f}' if isinstance(value, float) else
+                     f'{key}: {value}' for key, value in result.items())
+
+
+def arg_parser():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--layout',
+                        choices=('new', 'old', 'both'),
+                        default='both')
+    parser.add_argument('--dialogs',
+                        type=int,
+                        default=50,
+                        help='Dialog files per sex dir. Default: 50')
+    parser.add_argument('--messages',
+                        type=int,
+                        default=200,
+                        help='Incoming messages per dialog. Default: 200')
+    parser.add_argument('--photos-per-message', type=int, default=1)
+    parser.add_argument('--image-size',
+                        type=int,
+                        default=50 * 1024,
+                        help='Served image size (bytes). Default: 51200')
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0.02,
+                        help='Mean server latency (seconds). Default: 0.02')
+    parser.add_argument('--error-rate',
+                        type=float,
+                        default=0.0,
+                        help='Share of 503 answers. Default: 0')
+    parser.add_argument('--thread-count', type=int, default=100)
+    parser.add_argument('--parse-workers', type=int, default=None)
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--streaming-parse', action='store_true')
+    parser.add_argument('--pipeline', action='store_true')
+    parser.add_argument('--stages',
+                        nargs='+',
+                        choices=STAGES,
+                        default=list(STAGES))
+    parser.add_argument('--keep',
+                        default=None,
+                        help='Build the dump in this dir and keep it')
+    parser.add_argument('--json',
+                        default=None,
+                        help='Write results to this JSON file')
+    return parser.parse_args()
+
+
+def main():
+    options = arg_parser()
+    server = ImageServer(options.latency, options.error_rate,
+                         options.image_size)
+    server.start()
+    base_url = f'http://127.0.0.1:{server.port}'
+    work_dir = options.keep or tempfile.mkdtemp(prefix='vk_dump_bench_')
+    layouts = ('new', 'old') if options.layout == 'both' else (
+        options.layout, )
+    report = {'options': vars(options), 'results': {}}
+    try:
+        for layout_name in layouts:
+            root = os.path.join(work_dir, layout_name)
+            started = time.perf_counter()
+            links = generate_dump(root, LAYOUTS[layout_name], base_url,
+                                  options.dialogs, options.messages,
+                                  options.photos_per_message)
+            print(f'[{layout_name}] dump with {links} dialog links built in '
+                  f'{time.perf_counter() - started:.2f}s')
+            layout_results = report['results'].setdefault(layout_name, {})
+            for stage in options.stages:
+                result = run_stage(stage, options, layout_name, root)
+                layout_results[stage] = result
+                print(f'[{layout_name}] {stage}: {_format(result)}')
+    finally:
+        server.stop()
+        if options.keep is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    if options.json:
+        with open(options.json, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import multiprocessing
+import os
+import tarfile
+import warnings
+from zipfile import ZipFile
+
+import pytest
+
+from vk_dump_extractor.archive import ArchiveFormat, ArchiveShards
+
+FORMATS = [ArchiveFormat.TAR, ArchiveFormat.ZIP]
+
+
+def photo(index: int) -> bytes:
+    body = bytes([index % 251]) * (100 + index * 37)
+    return b'\xff\xd8' + body + b'\xff\xd9'
+
+
+def read_at(location):
+    path, offset, size = location
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        return file.read(size)
+
+
+def add_photos(shards: ArchiveShards, indexes):
+    for index in indexes:
+        shards.add(f'{index}.jpg', photo(index))
+
+
+@pytest.mark.parametrize('archive_format', FORMATS)
+def test_add_reopen_location(tmp_path, archive_format):
+    shards = ArchiveShards(str(tmp_path), archive_format, max_shard_size=2000)
+    add_photos(shards, range(10))
+    for index in range(10):
+        assert shards.read(f'{index}.jpg') == photo(index)
+    shards.close()
+
+    shards = ArchiveShards(str(tmp_path), archive_format, max_shard_size=2000)
+    add_photos(shards, range(10, 15))
+    shards.close()
+
+    shards = ArchiveShards(str(tmp_path), archive_format, max_shard_size=2000)
+    shard_paths = set()
+    for index in range(15):
+        location = shards.location(f'{index}.jpg')
+        assert read_at(location) == photo(index)
+        shard_paths.add(location[0])
+    shards.close()
+    assert len(shard_paths) > 1
+
+    names = set()
+    for path in shard_paths:
+        if archive_format is ArchiveFormat.TAR:
+            with tarfile.open(path) as tar:
+                names.update(tar.getnames())
+        else:
+            with ZipFile(path) as archive:
+                names.update(archive.namelist())
+    assert names == {f'{index}.jpg' for index in range(15)}
+
+
+def crash_while_adding(dir_path: str, archive_format: ArchiveFormat):
+    shards = ArchiveShards(dir_path, archive_format)
+    add_photos(shards, range(5))
+    shards._commit()
+    add_photos(shards, range(5, 8))  # data written, index not committed
+    shards._stream().flush()
+    os._exit(0)
+
+
+@pytest.mark.parametrize('archive_format', FORMATS)
+def test_reopen_after_crash(tmp_path, archive_format):
+    process = multiprocessing.Process(target=crash_while_adding,
+                                      args=(str(tmp_path), archive_format))
+    process.start()
+    process.join()
+
+    shards = ArchiveShards(str(tmp_path), archive_format)
+    assert not shards.contains('5.jpg')
+    add_photos(shards, range(5, 8))
+    shards.close()
+
+    shards = ArchiveShards(str(tmp_path), archive_format)
+    for index in range(8):
+        assert read_at(shards.location(f'{index}.jpg')) == photo(index)
+    shards.close()
+
+
+@pytest.mark.parametrize('archive_format', FORMATS)
+def test_add_after_discard(tmp_path, archive_format):
+    shards = ArchiveShards(str(tmp_path), archive_format)
+    add_photos(shards, range(3))
+    shards.discard('1.jpg')
+    assert shards.location('1.jpg') is None
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        shards.add('1.jpg', photo(100))
+    assert shards.read('1.jpg') == photo(100)
+    shards.close()
+
+    shards = ArchiveShards(str(tmp_path), archive_format)
+    assert read_at(shards.location('1.jpg')) == photo(100)
+    assert read_at(shards.location('2.jpg')) == photo(2)
+    shards.close()
@@ -0,0 +1,46 @@
+from vk_dump_extractor.jobs import JOB_INDEX_SIZE, Image, JobIndex, JobStore
+
+
+def test_job_index_grows_and_finds_every_key():
+    keys = [
+        f'/dump/photo/{number}.jpg' for number in range(JOB_INDEX_SIZE * 5)
+    ]
+    index = JobIndex(keys.__getitem__)
+    for number, key in enumerate(keys):
+        assert index.setdefault(key, number) == number
+    assert len(index) == len(keys)
+    for number, key in enumerate(keys):
+        assert index.get(key) == number
+        assert index.setdefault(key, len(keys)) == number
+    assert index.get('/dump/photo/missing.jpg') is None
+
+
+def test_job_index_confirms_tag_matches_by_key(monkeypatch):
+    keys = ['a', 'b', 'c']
+    index = JobIndex(keys.__getitem__)
+    # every key gets the same tag, so only the key comparison tells them
+    monkeypatch.setattr(JobIndex, '_tag', staticmethod(lambda key: 7))
+    for number, key in enumerate(keys):
+        assert index.setdefault(key, number) == number
+    assert [index.get(key) for key in keys] == [0, 1, 2]
+    assert index.get('d') is None
+
+
+def test_job_store_round_trip_and_group_turns():
+    store = JobStore()
+    images = [
+        Image(f'/dump/{group}/history.html',
+              f'https://example.com/{group}{number}.jpg',
+              f'Автор {number}', f'[2020-02-0{number + 1}_10-00]',
+              'w604' if number else '')
+        for group in 'ab' for number in range(3)
+    ]
+    for img in images:
+        store.queue(store.add(img), img.source_file)
+    for number, img in enumerate(images):
+        restored = store.image(number)
+        assert (restored.url, restored.path, restored.author, restored.date,
+                restored.source_file) == (img.url, img.path, img.author,
+                                          img.date, img.source_file)
+    assert store.queued_count == len(images)
+    assert list(store.iter_queued()) == [0, 3, 1, 4, 2, 5]
@@ -0,0 +1,91 @@
+import pytest
+
+from vk_dump_extractor.dialog_extractor import Extractor
+from vk_dump_extractor.parsing import HtmlFile, HtmlTypeDoc, LinkCollector
+
+
+def dialog_html(extension: str, messages: int, newline: str) -> str:
+    lines = ['<html><head><title>Диалог</title></head><body>']
+    if extension == 'htm':
+        lines.append('<table>')
+    for message in range(messages):
+        # text mode reads CRLF as LF, split parts must give the same author
+        author = f'{newline}Автор {message % 3}{newline}'
+        date = f'{1 + message % 28:02}.02.2020 {message % 24:02}:00'
+        url = f'https://example.com/{message}.jpg?size=604x453'
+        if extension == 'htm':
+            lines.append(
+                f'<tr class="im_in"><td>'
+                f'<div class="im_log_author_chat_name">{author}</div>'
+                f'<a class="im_date_link" href="#">{date}</a></td>'
+                f'<td><a href="{url}">photo</a></td></tr>')
+            continue
+        lines.append(
+            f'<div class="im_in">{newline}'
+            f'<div class="im_log_author_chat_name">{author}</div>'
+            f'<a class="im_date_link" href="#">{date}</a>{newline}'
+            f'<div class="im_text">line one{newline}line two</div>'
+            f'<a class="download_photo_type" href="{url}">photo</a></div>')
+        lines.append('<div class="im_out"><a class="download_photo_type" '
+                     'href="https://example.com/out.jpg">photo</a></div>')
+    lines.append('</table></body></html>' if extension == 'htm' else
+                 '</body></html>')
+    return newline.join(lines)
+
+
+@pytest.fixture(params=[('html', '\n'), ('html', '\r\n'), ('htm', '\n'),
+                        ('htm', '\r\n')],
+                ids=['html-lf', 'html-crlf', 'htm-lf', 'htm-crlf'])
+def make_dialog(request, tmp_path):
+    extension, newline = request.param
+
+    def make(messages: int) -> HtmlFile:
+        path = tmp_path / f'history_0.{extension}'
+        path.write_bytes(
+            dialog_html(extension, messages, newline).encode('utf-8'))
+        return HtmlFile(str(path), HtmlTypeDoc.DIALOG)
+
+    return make
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_split_parts_match_whole_file(make_dialog, streaming):
+    html_file = make_dialog(50)
+    expected = LinkCollector().collect(html_file)
+    # .htm messages give their im_date_link href as well
+    assert len([record for record in expected if record.url != '#']) == 50
+    assert LinkCollector(streaming=True).collect(html_file) == expected
+
+    collector = LinkCollector(streaming=streaming)
+    ranges = collector.split_dialog(html_file, 7)
+    assert len(ranges) == 7
+    records = [
+        record for start, end in ranges
+        for record in collector.collect_range(html_file, start, end)
+    ]
+    assert records == expected
+
+
+@pytest.mark.parametrize('messages', [0, 1])
+def test_too_short_to_split(make_dialog, messages):
+    html_file = make_dialog(messages)
+    collector = LinkCollector()
+    ranges = collector.split_dialog(html_file, 4)
+    assert len(ranges) <= messages + 1
+    records = [
+        record for start, end in ranges
+        for record in collector.collect_range(html_file, start, end)
+    ]
+    assert records == collector.collect(html_file)
+
+
+def test_extractor_merges_parts(make_dialog):
+    html_file = make_dialog(50)
+    extractor = Extractor(1,
+                          parse_workers=1,
+                          split_parse_size=1024,
+                          include_chat_with_girls=True)
+    assert len(extractor._parse_tasks([html_file])) > 1
+    [(file_path, records)] = extractor.iter_parsed_records([html_file])
+    assert file_path == html_file.file_path
+    assert records == LinkCollector().collect(html_file)
@@ -0,0 +1,221 @@
+import os
+import sqlite3
+import tarfile
+import threading
+import time
+from enum import Enum
+from typing import Optional, Tuple
+from zipfile import ZIP_STORED, ZipFile, ZipInfo
+
+from .jobs import Image
+from .storage import MANIFEST_COMMIT_EVERY, FsyncPolicy
+
+
+class ArchiveFormat(Enum):
+    TAR = 'tar'
+    ZIP = 'zip'
+
+
+ARCHIVE_SHARD_SIZE = 1024**3
+ARCHIVE_INDEX_NAME = 'index.sqlite'
+
+
+class ArchiveShards:
+    """Photos of one photo dir packed into size-capped tar/zip shards.
+
+    ``index.sqlite`` next to the shards maps photo names to (shard, data
+    offset, size), so lookups and reads need no per-photo file metadata.
+    A tar shard is cut back to its last indexed photo when reopened. To a
+    zip shard left without a central directory by a crash, a new zip is
+    appended, index offsets of the old photos stay valid.
+    """
+    def __init__(self,
+                 dir_path: str,
+                 archive_format: ArchiveFormat = ArchiveFormat.TAR,
+                 max_shard_size: int = ARCHIVE_SHARD_SIZE,
+                 fsync: FsyncPolicy = FsyncPolicy.NONE):
+        self._dir_path = dir_path
+        self._format = archive_format
+        self._max_shard_size = max_shard_size
+        self._fsync = fsync
+        self._lock = threading.Lock()
+        os.makedirs(dir_path, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(dir_path,
+                                                ARCHIVE_INDEX_NAME),
+                                   check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS members ('
+                         'name TEXT PRIMARY KEY, shard INTEGER NOT NULL, '
+                         'offset INTEGER NOT NULL, size INTEGER NOT NULL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS shards ('
+                         'shard INTEGER PRIMARY KEY, end INTEGER NOT NULL)')
+        self._db.commit()
+        row = self._db.execute('SELECT shard, end FROM shards '
+                               'ORDER BY shard DESC LIMIT 1').fetchone()
+        self._shard, self._end = row or (0, 0)
+        self._uncommitted = 0
+        self._file = None
+        self._zip = None
+        self._open_shard()
+
+    def shard_path(self, shard: int) -> str:
+        return os.path.join(self._dir_path,
+                            f'shard-{shard:05d}.{self._format.value}')
+
+    def _open_shard(self):
+        path = self.shard_path(self._shard)
+        exists = os.path.exists(path)
+        if self._format is ArchiveFormat.TAR:
+            self._file = open(path, 'r+b' if exists else 'w+b')
+            self._file.truncate(self._end)
+            self._file.seek(self._end)
+            return
+        self._zip = ZipFile(path, 'a' if exists else 'w')
+        self._end = self._zip.start_dir
+
+    def _close_shard(self):
+        if self._format is ArchiveFormat.TAR:
+            self._file.write(b'\0' * tarfile.BLOCKSIZE * 2)
+            self._file.close()
+        else:
+            self._zip.close()
+
+    def _append_tar(self, name: str, data: bytes) -> int:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        header = info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+        padding = -len(data) % tarfile.BLOCKSIZE
+        self._file.write(header)
+        self._file.write(data)
+        self._file.write(b'\0' * padding)
+        offset = self._end + len(header)
+        self._end = offset + len(data) + padding
+        return offset
+
+    def _append_zip(self, name: str, data: bytes) -> int:
+        info = ZipInfo(name, time.localtime()[:6])
+        info.compress_type = ZIP_STORED
+        self._zip.writestr(info, data)
+        self._end = self._zip.start_dir
+        return (info.header_offset + 30 + len(info.filename.encode()) +
+                len(info.extra))
+
+    def _stream(self):
+        return self._file if self._format is ArchiveFormat.TAR \
+            else self._zip.fp
+
+    def _commit(self):
+        stream = self._stream()
+        stream.flush()
+        if self._fsync is not FsyncPolicy.NONE:
+            os.fsync(stream.fileno())
+        self._db.execute('INSERT OR REPLACE INTO shards VALUES (?, ?)',
+                         (self._shard, self._end))
+        self._db.commit()
+        self._uncommitted = 0
+
+    def _needs_new_shard(self, name: str, size: int) -> bool:
+        if self._end and self._end + size > self._max_shard_size:
+            return True
+        # a photo added again after discard would duplicate a zip name
+        return self._format is ArchiveFormat.ZIP and \
+            name in self._zip.NameToInfo
+
+    def add(self, name: str, data: bytes):
+        with self._lock:
+            if self._needs_new_shard(name, len(data)):
+                self._commit()
+                self._close_shard()
+                self._shard += 1
+                self._end = 0
+                self._open_shard()
+            if self._format is ArchiveFormat.TAR:
+                offset = self._append_tar(name, data)
+            else:
+                offset = self._append_zip(name, data)
+            self._db.execute(
+                'INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?)',
+                (name, self._shard, offset, len(data)))
+            self._uncommitted += 1
+            if self._uncommitted >= MANIFEST_COMMIT_EVERY:
+                self._commit()
+
+    def contains(self, name: str) -> bool:
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM members WHERE name = ?',
+                                    (name, )).fetchone() is not None
+
+    def location(self, name: str) -> Optional[Tuple[str, int, int]]:
+        """(shard path, data offset, size) of the photo."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT shard, offset, size FROM members WHERE name = ?',
+                (name, )).fetchone()
+        if row is None:
+            return None
+        shard, offset, size = row
+        return self.shard_path(shard), offset, size
+
+    def read(self, name: str) -> Optional[bytes]:
+        with self._lock:
+            # recent photos may still be in the write buffer
+            self._stream().flush()
+        location = self.location(name)
+        if location is None:
+            return None
+        path, offset, size = location
+        with open(path, 'rb') as file:
+            file.seek(offset)
+            return file.read(size)
+
+    def discard(self, name: str):
+        """Forget the photo, its data stays in the shard unused."""
+        with self._lock:
+            self._db.execute('DELETE FROM members WHERE name = ?', (name, ))
+            self._uncommitted += 1
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._close_shard()
+            self._db.close()
+
+
+class ArchiveOutput:
+    """Archive shards instead of photo files, one set per photo dir."""
+    def __init__(self,
+                 archive_format: ArchiveFormat = ArchiveFormat.TAR,
+                 max_shard_size: int = ARCHIVE_SHARD_SIZE,
+                 fsync: FsyncPolicy = FsyncPolicy.NONE):
+        self._format = archive_format
+        self._max_shard_size = max_shard_size
+        self._fsync = fsync
+        self._shards = {}
+        self._lock = threading.Lock()
+
+    def shards_of(self, dir_path: str) -> ArchiveShards:
+        with self._lock:
+            shards = self._shards.get(dir_path)
+            if shards is None:
+                shards = self._shards[dir_path] = ArchiveShards(
+                    dir_path, self._format, self._max_shard_size,
+                    self._fsync)
+            return shards
+
+    def contains(self, img: Image) -> bool:
+        return self.shards_of(img.file_dir).contains(img.name)
+
+    def add(self, img: Image, data: bytes):
+        self.shards_of(img.file_dir).add(img.name, data)
+
+    def location(self, img: Image) -> Optional[Tuple[str, int, int]]:
+        return self.shards_of(img.file_dir).location(img.name)
+
+    def discard(self, img: Image):
+        self.shards_of(img.file_dir).discard(img.name)
+
+    def close(self):
+        with self._lock:
+            for shards in self._shards.values():
+                shards.close()
+            self._shards.clear()
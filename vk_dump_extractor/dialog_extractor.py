@@ -1,44 +1,36 @@
 #!/usr/bin/env python3
 
 import asyncio
+import os
 import sys
-from argparse import ArgumentParser
-from datetime import datetime
+from argparse import ArgumentParser, ArgumentTypeError
 
 try:
-    from typing import Optional, List
+    from typing import Dict, Iterator, List, Optional, Tuple
     if sys.version_info < (3, 7):
         raise ImportError
 except ImportError as error:
     raise Exception('Update your python to 3.7+') from error
 
-import os
-import re
-from enum import Enum, auto
-from multiprocessing.dummy import Pool as ThreadPool
-
-import aiofiles
-import aiohttp
-from bs4 import BeautifulSoup
-from tqdm.asyncio import tqdm
-
-
-def get_soup(html_file_path):
-    return BeautifulSoup(html_file_path, 'html.parser')
-
-
-class HtmlTypeDoc(Enum):
-    PHOTOS_ONLY = auto()
-    DIALOG = auto()
-
-
-class ParserMode(Enum):
-    TARGET_FILE = auto()
-    AUTO_SEARCH = auto()
-
+from enum import Enum
+from multiprocessing import Pool as ProcessPool
+
+from .archive import ARCHIVE_SHARD_SIZE, ArchiveFormat, ArchiveOutput
+from .downloader import Downloader
+from .jobs import (DownloadOrder, JobPriority, LinkRecord, SizeVariant,
+                   VariantPolicy, roundrobin)
+from .metrics import Metrics
+from .network import ConnectionOptions, RetryPolicy, TokenBucket
+from .parsing import (DISCOVERY_WORKERS, FileChecker, HtmlFile, HtmlTypeDoc,
+                      ParseCache, Parser, ParseTask)
+from .storage import (DISK_WRITERS, DiskWriter, DownloadManifest, FsyncPolicy,
+                      VerifyOptions)
+from .watch import WATCH_POLL_INTERVAL, WATCH_SETTLE, DumpWatcher
 
 POSSIBLE_HTML_EXT = ['html', 'htm']
-VALID_PICTURE_TRAIL = ['.jpg', '.jpeg']
+PIPELINE_QUEUE_SIZE = 16
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+SPLIT_PARSE_SIZE = 8 * 1024 * 1024
 
 
 class DefaultDirNames(Enum):
@@ -48,358 +40,50 @@ class DefaultDirNames(Enum):
     BOYS_DIR = 'Парни'
 
 
-class Image:
-    def __init__(self, source_file, url, author='', date=''):
-        self._path = self.path_generator(source_file, url, author, date)
-        self._url = url
-
-    @property
-    def path(self):
-        return self._path
-
-    @property
-    def url(self):
-        return self._url
-
-    @property
-    def file_dir(self):
-        return os.path.dirname(self.path)
-
-    @staticmethod
-    def path_generator(source_file, url, author, date):
-        name = '_'.join((date, author, url.split('/')[-1]))
-        name = re.sub(r'[_]+', '_', name)
-        name = name.split('?')[0]
-        return os.path.join(os.path.dirname(source_file), 'photo', name)
-
-
-class Downloader:
-    def __init__(self, thread_count):
-        self._header = {
-            'Accept':
-            'text/html,application/xhtml+xml,'
-            'application/xml;q=0.9,image/webp,image/apng,'
-            '*/*;q=0.8,application/signed-exchange;v=b3;q=0.9',
-            'Accept-Encoding':
-            'gzip, deflate, br',
-            'User-Agent':
-            'Mozilla/5.0 (Windows NT 6.1; Win64; x64) '
-            'AppleWebKit/537.36 (KHTML, like Gecko) '
-            'Chrome/80.0.3987.149 Safari/537.36'
-        }
-        self._semaphore = asyncio.Semaphore(thread_count)
-        self._download_list = []
-        # self._link_set = set()  # deprecated
-        self._name_set = set()
-        self._session = None
-
-    @property
-    def total_count(self):
-        return len(self._download_list)
-
-    async def save_photo(self, img: Image):
-        if os.path.isfile(img.path):
-            return None
-        try:
-            async with self._semaphore, self._session.get(img.url) as resp:
-                if resp.status != 200:
-                    raise aiohttp.ClientError(
-                        f'{img.url} '
-                        f'return code {resp.status} (not 200)')
-                os.makedirs(img.file_dir, exist_ok=True)
-                async with aiofiles.open(img.path, mode='wb') as file:
-                    await file.write(await resp.read())
-                return False
-        except (aiohttp.ClientError, OSError, TimeoutError) as err:
-            print(f'{err} - {img.url}')
-            return img
-
-    async def download_files(self):
-        async with aiohttp.ClientSession(
-                headers=self._header) as self._session:
-            results = await tqdm.gather(
-                *[self.save_photo(file) for file in self._download_list])
-            skipped_count = len([res for res in results if res is None])
-            downloaded_count = (len([res for res in results if not res]) -
-                                skipped_count)
-            error_count = len(results) - skipped_count - downloaded_count
-            print(f'Skipped file count: {skipped_count}')
-            print(f'Downloaded file count: {downloaded_count}')
-            print(f'Error file count: {error_count}')
-
-    @staticmethod
-    def _link_validator(url: str):
-        trailed_url = url.split('?')[0]
-        valid_head = trailed_url.startswith('http')
-        valid_trail = any(
-            trailed_url.endswith(trail) for trail in VALID_PICTURE_TRAIL)
-        return valid_head and valid_trail
-
-    @staticmethod
-    def generate_image_object(source_file, url, author='', date=''):
-        return Image(source_file, url, author, date)
-
-    def push_img(self, image: Image):
-        if image.path in self._name_set:
-            return True
-        if not self._link_validator(image.url):
-            return False
-        self._name_set.add(image.path)
-        self._download_list.append(image)
-        return True
-
-
-class FileChecker:
-    def __init__(self,
-                 common_title='Общий лист фотографий',
-                 photo_html_name='photos.html',
-                 dialog_pattern=r'history_.\d*\.htm'):
-        self._common_title = common_title
-        self._photo_html = photo_html_name
-        self._dialog_pattern = dialog_pattern
-
-    def check_by_html(self, file_path: str) -> Optional[HtmlTypeDoc]:
-        print('extra check')
-        with open(file_path, encoding='utf-8') as file:
-            soup = get_soup(file)
-            title = soup.title
-            if title is None:
-                return None
-            if title.text == self._common_title:
-                return HtmlTypeDoc.PHOTOS_ONLY
-            return HtmlTypeDoc.DIALOG
-
-    def check_by_file_name(self, file_path: str,
-                           need_to_check_file=False) -> \
-            Optional[HtmlTypeDoc]:
-        file_name = os.path.basename(file_path)
-        if file_name == self._photo_html:
-            return HtmlTypeDoc.PHOTOS_ONLY
-        if re.search(self._dialog_pattern, file_name):
-            return HtmlTypeDoc.DIALOG
-        if need_to_check_file:
-            return self.check_by_html(file_path)
-        return None
-
-
-class HtmlFile:
-    def __init__(self, file_path: str, file_type: HtmlTypeDoc):
-        self._file_path = file_path
-        self._file_type = file_type
-
-    @property
-    def is_htm(self):
-        return not self._file_path.endswith('html')
-
-    @property
-    def filename(self):
-        return os.path.basename(self._file_path)
-
-    @property
-    def file_path(self):
-        return self._file_path
-
-    @property
-    def file_type(self):
-        return self._file_type
-
-
-class Parser:
-    def __init__(self,
-                 file_checker: FileChecker,
-                 download_manager: Downloader,
-                 *,
-                 include_attachment_girls: bool = False,
-                 include_attachment_boys: bool = False,
-                 include_chat_with_girls: bool = False,
-                 include_chat_with_boys: bool = False,
-                 manual_file=False,
-                 attachment_path_name: str = 'Вложения',
-                 chat_path_name: str = 'Диалоги',
-                 girls_dir: str = 'Девочки',
-                 boys_dir: str = 'Парни'):
-        self._file_checker = file_checker
-        self._download_manager = download_manager
-        self._include_attachment_girls = include_attachment_girls
-        self._include_attachment_boys = include_attachment_boys
-        self._include_chat_with_girls = include_chat_with_girls
-        self._include_chat_with_boys = include_chat_with_boys
-        if not any((include_attachment_girls, include_chat_with_girls,
-                    include_attachment_boys,
-                    include_chat_with_boys)) and not manual_file:
-            raise ValueError(
-                'No sources type (attach or/and dialog) to download!')
-        self._mode = (ParserMode.TARGET_FILE
-                      if manual_file else ParserMode.AUTO_SEARCH)
-        self._attachment_path_name = attachment_path_name
-        self._chat_path_name = chat_path_name
-        self._girls_dir = girls_dir
-        self._boys_dir = boys_dir
-        self._common_path = None
-        self._chat_path = None
-
-    @property
-    def parser_mode(self):
-        return self._mode
-
-    @staticmethod
-    def _path_generator(root_folder, folder, include):
-        if root_folder is None or not include:
-            return '\0'
-        return os.path.join(root_folder, folder)
-
-    @property
-    def _common_girls(self):
-        return self._path_generator(self._common_path, self._girls_dir,
-                                    self._include_attachment_girls)
-
-    @property
-    def _common_boys(self):
-        return self._path_generator(self._common_path, self._boys_dir,
-                                    self._include_attachment_boys)
-
-    @property
-    def _chat_girls(self):
-        return self._path_generator(self._chat_path, self._girls_dir,
-                                    self._include_chat_with_girls)
-
-    @property
-    def _chat_boys(self):
-        return self._path_generator(self._chat_path, self._boys_dir,
-                                    self._include_chat_with_boys)
-
-    @property
-    def _common_paths(self):
-        return self._common_girls, self._common_boys
-
-    @property
-    def _chat_paths(self):
-        return self._chat_boys, self._chat_girls
-
-    def _get_normal_files(self, dir_path: str, file_type: HtmlTypeDoc):
-        files = []
-        for file in os.listdir(dir_path):
-            file_name = os.path.join(dir_path, file)
-            if self._file_checker.check_by_file_name(file_name) is file_type:
-                files.append(HtmlFile(file_name, file_type))
-        return files
-
-    def _get_files(self, dir_path, filenames):
-        if not any(
-                file.endswith(ext) for ext in POSSIBLE_HTML_EXT
-                for file in filenames):
-            return []
-        for common in self._common_paths:
-            if common in dir_path:
-                return self._get_normal_files(dir_path,
-                                              HtmlTypeDoc.PHOTOS_ONLY)
-        for chat in self._chat_paths:
-            if chat in dir_path:
-                return self._get_normal_files(dir_path, HtmlTypeDoc.DIALOG)
-        return []
-
-    @staticmethod
-    def _get_image_container_and_a_filter(file):
-        if file.is_htm:
-            return 'tr', None
-        return 'div', {'class': 'download_photo_type'}
-
-    def _collect_links_from_dialog(self, file):
-        file_name = file.file_path
-        with open(file_name, encoding='utf-8') as f:
-            html = f.read()
-        result = []
-        img_container, a_filter = self._get_image_container_and_a_filter(file)
-        for message in BeautifulSoup(html, 'html.parser').find_all(
-                img_container, {'class': 'im_in'}):
-            photos = message.find_all('a', a_filter, href=True)
-            if not photos:
-                continue
-            photos = [img['href'] for img in photos]
-            author = message.find('div', {
-                'class': 'im_log_author_chat_name'
-            }).text
-            str_date = message.find('a', {'class': 'im_date_link'}).text
-            date_time = datetime.strptime(str_date, '%d.%m.%Y %H:%M')
-            date = date_time.strftime('[%Y-%m-%d_%H-%M]')
-            for url in photos:
-                if not url:
-                    continue
-                result.append(
-                    self._download_manager.generate_image_object(
-                        file_name, url, author, date))
-        print(f'{len(result)} links parsed from {file_name}')
-        return result
-
-    def _collect_links_from_attachment(self, file):
-        file_name = file.file_path
-        with open(file_name, encoding='utf-8') as f:
-            html = f.read()
-        soup = BeautifulSoup(html, 'html.parser')
-        _, a_filter = self._get_image_container_and_a_filter(file)
-        photos = soup.find_all('a', a_filter, href=True)
-        result = []
-        for photo in photos:
-            url = photo.get('href')
-            if url and url.startswith('http'):
-                result.append(
-                    self._download_manager.generate_image_object(
-                        file_name, url))
-        print(f'{len(result)} links parsed from {file_name}')
-        return result
-
-    def search_html(self, root_path_for_search: str):
-        files = []
-        if self._chat_path_name == ".":
-            chat_dir = os.path.basename(root_path_for_search)
-        else:
-            chat_dir = self._chat_path_name
-        for dir_path, _, filenames in os.walk(root_path_for_search):
-            if os.path.basename(dir_path) == self._attachment_path_name:
-                if not any((
-                        self._include_attachment_boys,
-                        self._include_attachment_girls,
-                )):
-                    continue
-                self._common_path = dir_path
-            elif os.path.basename(dir_path) == chat_dir:
-                if not any((self._include_chat_with_boys,
-                            self._include_chat_with_girls)):
-                    continue
-                self._chat_path = dir_path
-            files.extend(self._get_files(dir_path, filenames))
-        return files
-
-    def get_manual_file(self, file_path):
-        file_type = self._file_checker.check_by_html(file_path)
-        if file_type is None:
-            raise ValueError('Incorrect file')
-        return HtmlFile(file_path, file_type)
-
-    def parse_url_from_html(self, html_file: HtmlFile):
-        if html_file.file_type is HtmlTypeDoc.DIALOG:
-            return self._collect_links_from_dialog(html_file)
-        if html_file.file_type is HtmlTypeDoc.PHOTOS_ONLY:
-            return self._collect_links_from_attachment(html_file)
-        raise NotImplementedError
-
-
 class Extractor:
     def __init__(self,
                  thread_count,
                  *,
+                 parse_workers: Optional[int] = None,
+                 parse_cache: Optional[ParseCache] = None,
+                 connection_options: Optional[ConnectionOptions] = None,
+                 retry_policy: Optional[RetryPolicy] = None,
+                 adaptive_concurrency: bool = True,
+                 manifest: Optional[DownloadManifest] = None,
+                 retry_failed: bool = False,
+                 dedup: bool = False,
+                 metrics: Optional[Metrics] = None,
+                 disk_writer: Optional[DiskWriter] = None,
+                 priority: Optional[JobPriority] = None,
+                 bandwidth: Optional[TokenBucket] = None,
+                 variant_policy: Optional[VariantPolicy] = None,
+                 archive: Optional[ArchiveOutput] = None,
+                 verify: Optional[VerifyOptions] = None,
                  include_attachment_girls: bool = False,
                  include_attachment_boys: bool = False,
                  include_chat_with_girls: bool = False,
                  include_chat_with_boys: bool = False,
                  manual_file=False,
+                 streaming_parse: bool = False,
+                 profile_dir: Optional[str] = None,
+                 discovery_workers: int = DISCOVERY_WORKERS,
+                 split_parse_size: int = SPLIT_PARSE_SIZE,
                  attachment_path_name: str = 'Вложения',
                  chat_path_name: str = 'Диалоги',
                  girls_dir: str = 'Девочки',
                  boys_dir: str = 'Парни',
                  photo_file_name: str = 'photos.html'):
+        self._parse_workers = parse_workers or os.cpu_count() or 1
+        self._split_parse_size = split_parse_size
+        self._parse_cache = parse_cache
+        self._metrics = metrics or Metrics()
         self._file_checker = FileChecker(photo_html_name=photo_file_name)
-        self._downloader = Downloader(thread_count)
+        self._downloader = Downloader(thread_count, connection_options,
+                                      retry_policy, adaptive_concurrency,
+                                      manifest, retry_failed, dedup,
+                                      self._metrics, disk_writer, priority,
+                                      bandwidth, variant_policy, archive,
+                                      verify)
         self._parser = Parser(
             self._file_checker,
             self._downloader,
@@ -408,6 +92,9 @@ class Extractor:
             include_chat_with_girls=include_chat_with_girls,
             include_chat_with_boys=include_chat_with_boys,
             manual_file=manual_file,
+            streaming_parse=streaming_parse,
+            profile_dir=profile_dir,
+            discovery_workers=discovery_workers,
             attachment_path_name=attachment_path_name,
             chat_path_name=chat_path_name,
             girls_dir=girls_dir,
@@ -421,25 +108,227 @@ class Extractor:
     def downloader(self):
         return self._downloader
 
-    async def download_from_html_files(self, files: List[HtmlFile]):
-        print(f'Total file count: {len(files)}')
-        if len(files) == 1:
-            result = self.parser.parse_url_from_html(files[0])
+    @property
+    def metrics(self):
+        return self._metrics
+
+    def _iter_cached_records(self, files: List[HtmlFile],
+                             not_cached: List[HtmlFile]):
+        for file in files:
+            records = self._parse_cache.get(file)
+            if records is None:
+                not_cached.append(file)
+            else:
+                yield file.file_path, records
+
+    def iter_parsed_records(self, files: List[HtmlFile]) -> \
+            Iterator[Tuple[str, List[LinkRecord]]]:
+        if self._parse_cache is not None:
+            not_cached = []
+            yield from self._iter_cached_records(files, not_cached)
+            self._metrics.inc('parse_cache_hits',
+                              len(files) - len(not_cached))
+            print(f'Parse cache hits: {len(files) - len(not_cached)}')
+            files_by_path = {file.file_path: file for file in not_cached}
+            for file_path, records in self._iter_collected_records(
+                    not_cached):
+                self._parse_cache.put(files_by_path[file_path], records)
+                yield file_path, records
         else:
-            with ThreadPool() as pool:
-                result = pool.map(self.parser.parse_url_from_html, files)
-                result = sum(result, [])
-
-        print(f'Urls collected: {len(result)}')
-        print('Start filtering')
-        for img in result:
-            if not self.downloader.push_img(img):
-                print(f'Invalid image url: {img.url}')
+            yield from self._iter_collected_records(files)
+
+    def _iter_collected_records(self, files: List[HtmlFile]) -> \
+            Iterator[Tuple[str, List[LinkRecord]]]:
+        for file_path, records, seconds in self._iter_parse_results(files):
+            self._metrics.observe_parse(seconds)
+            self._metrics.inc('parsed_files')
+            self._metrics.inc('links_collected', len(records))
+            yield file_path, records
+
+    def _parse_tasks(self, files: List[HtmlFile]) -> List[ParseTask]:
+        """Big dialogs are split to be parsed by all the workers."""
+        tasks = []
+        for file in files:
+            if file.file_type is not HtmlTypeDoc.DIALOG or \
+                    not self._split_parse_size:
+                tasks.append(ParseTask(file))
+                continue
+            size = os.path.getsize(file.file_path)
+            if size <= self._split_parse_size:
+                tasks.append(ParseTask(file))
+                continue
+            part_count = max(self._parse_workers,
+                             -(-size // self._split_parse_size))
+            ranges = self.parser.link_collector.split_dialog(file,
+                                                             part_count)
+            tasks.extend(
+                ParseTask(file, part, len(ranges), start, end)
+                for part, (start, end) in enumerate(ranges))
+        return tasks
+
+    @staticmethod
+    def _merge_parts(results):
+        """Join the parts of split files back in order."""
+        parts = {}
+        for task, records, seconds in results:
+            file_path = task.html_file.file_path
+            if task.part_count == 1:
+                yield file_path, records, seconds
+                continue
+            file_parts = parts.setdefault(file_path, {})
+            file_parts[task.part] = records, seconds
+            if len(file_parts) < task.part_count:
+                continue
+            del parts[file_path]
+            yield (file_path, [
+                record for part in range(task.part_count)
+                for record in file_parts[part][0]
+            ], sum(seconds for _, seconds in file_parts.values()))
+
+    def _iter_parse_results(self, files: List[HtmlFile]):
+        """Parse results as they come, the consumer time is not counted."""
+        collector = self.parser.link_collector
+        with self._metrics.timer('parse'):
+            tasks = self._parse_tasks(files)
+        workers = min(self._parse_workers, len(tasks))
+        if workers <= 1:
+            yield from self._merge_parts(
+                self._metrics.timed(
+                    'parse', (collector.collect_task(task) for task in tasks)))
+            return
+        with self._metrics.timer('parse'):
+            pool = ProcessPool(workers)
+        with pool:
+            yield from self._merge_parts(
+                self._metrics.timed(
+                    'parse', pool.imap_unordered(collector.collect_task,
+                                                 tasks)))
+
+    def collect_images(self,
+                       files: List[HtmlFile],
+                       file_groups: Optional[Dict[str, str]] = None):
+        print(f'Total file count: {len(files)}')
+        file_groups = file_groups or {}
+        collected_count = 0
+        print('Start parsing and filtering')
+        for file_path, records in self.iter_parsed_records(files):
+            print(f'{len(records)} links parsed from {file_path}')
+            collected_count += len(records)
+            group = file_groups.get(file_path, '')
+            with self._metrics.timer('filtering'):
+                for img in self.parser.images_from_records(
+                        file_path, records):
+                    if not self.downloader.push_img(img, group):
+                        self._metrics.inc('invalid_urls')
+                        print(f'Invalid image url: {img.url}')
+
+        print(f'Urls collected: {collected_count}')
         print(f'Valid images after filtering: '
               f'{self.downloader.total_count}')
+
+    async def download_from_html_files(
+            self,
+            files: List[HtmlFile],
+            file_groups: Optional[Dict[str, str]] = None):
+        self.collect_images(files, file_groups)
         print('Start downloading files')
         await self.downloader.download_files()
 
+    async def download_from_html_files_pipelined(self,
+                                                 files: List[HtmlFile]):
+        print(f'Total file count: {len(files)}')
+        print('Start pipelined parsing and downloading')
+        loop = asyncio.get_running_loop()
+        batches = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+
+        def put(batch):
+            asyncio.run_coroutine_threadsafe(batches.put(batch),
+                                             loop).result()
+
+        def produce():
+            collected_count = 0
+            try:
+                for file_path, records in self.iter_parsed_records(files):
+                    print(f'{len(records)} links parsed from {file_path}')
+                    collected_count += len(records)
+                    put(self.parser.images_from_records(file_path, records))
+            finally:
+                put(None)
+            return collected_count
+
+        producer = loop.run_in_executor(None, produce)
+        await self.downloader.download_pipelined(batches)
+        print(f'Urls collected: {await producer}')
+
+    async def download_from_dumps(self,
+                                  dumps: Dict[str, List[HtmlFile]],
+                                  pipelined: bool = False):
+        """Process several dumps with one session and one dedup set.
+
+        Files and downloads of the dumps take turns, so a huge dump can't
+        hold back the small ones.
+        """
+        files, file_groups = self._flatten_dumps(dumps)
+        if pipelined:
+            await self.download_from_html_files_pipelined(files)
+        else:
+            await self.download_from_html_files(files, file_groups)
+
+    async def watch_dumps(self,
+                          roots: List[str],
+                          settle: float = WATCH_SETTLE,
+                          poll_interval: float = WATCH_POLL_INTERVAL,
+                          idle_exit: float = 0):
+        """Download from dump files while the dumper is still writing.
+
+        Finished files are parsed as they appear and their images go to
+        one long-running pipelined download.
+        """
+        print(f'Watching {", ".join(roots)}')
+        loop = asyncio.get_running_loop()
+        batches = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        watcher = DumpWatcher(self.parser, roots, settle, poll_interval)
+
+        async def produce():
+            collected_count = 0
+            try:
+                async for files in watcher.changes(idle_exit):
+                    # the generator body runs in the executor thread
+                    parsed = await loop.run_in_executor(
+                        None, list, self.iter_parsed_records(files))
+                    for file_path, records in parsed:
+                        print(f'{len(records)} links parsed from '
+                              f'{file_path}')
+                        collected_count += len(records)
+                        await batches.put(
+                            self.parser.images_from_records(
+                                file_path, records))
+            finally:
+                await batches.put(None)
+            return collected_count
+
+        producer = asyncio.ensure_future(produce())
+        await self.downloader.download_pipelined(batches)
+        print(f'Urls collected: {await producer}')
+
+    @staticmethod
+    def _flatten_dumps(dumps: Dict[str, List[HtmlFile]]):
+        for target, files in dumps.items():
+            print(f'{target}: {len(files)} files')
+        files = list(roundrobin(*dumps.values()))
+        file_groups = {
+            file.file_path: target
+            for target, target_files in dumps.items()
+            for file in target_files
+        }
+        return files, file_groups
+
+    def plan_dumps(self, dumps: Dict[str, List[HtmlFile]], plan_path: str):
+        """Parse and filter only, jobs are written for a later fetch."""
+        self.collect_images(*self._flatten_dumps(dumps))
+        job_count = self.downloader.write_plan(plan_path)
+        print(f'{job_count} jobs written to {plan_path}')
+
     @classmethod
     def is_input_html_file(cls, target_path):
         if not os.path.exists(target_path):
@@ -451,10 +340,11 @@ class Extractor:
 
     def get_files(self, target_path: str,
                   is_manual_html: bool) -> List[HtmlFile]:
-        if is_manual_html:
-            return [self.parser.get_manual_file(target_path)]
-        if os.path.isdir(target_path):
-            return self.parser.search_html(target_path)
+        with self._metrics.timer('discovery'):
+            if is_manual_html:
+                return [self.parser.get_manual_file(target_path)]
+            if os.path.isdir(target_path):
+                return self.parser.search_html(target_path)
         raise ValueError('Unknown target')
 
 
@@ -462,8 +352,12 @@ def arg_parser():
     parser = ArgumentParser()
     parser.add_argument('-t',
                         '--target-dir-file-path',
-                        help='Target path',
-                        required=True)
+                        action='append',
+                        default=[],
+                        help='Target path, can be repeated (batch mode)')
+    parser.add_argument('--targets-file',
+                        default=None,
+                        help='File with target paths, one per line')
     parser.add_argument('-ag',
                         '--attachment-girls',
                         action='store_true',
@@ -519,26 +413,385 @@ def arg_parser():
                         type=int,
                         help=(f'Max download coroutines (thread) count. '
                               f'Default: {default_thread_count}'))
-    return parser.parse_args()
+    default_options = ConnectionOptions()
+    parser.add_argument('--total-connections',
+                        default=default_options.total_limit,
+                        type=int,
+                        help='Max open connections. Default: thread count')
+    parser.add_argument('--per-host-limit',
+                        default=default_options.per_host_limit,
+                        type=int,
+                        help=('Max simultaneous downloads from one host. '
+                              'Default: no limit'))
+    parser.add_argument('--dns-cache-ttl',
+                        default=default_options.dns_cache_ttl,
+                        type=int,
+                        help=(f'DNS cache ttl (seconds). '
+                              f'Default: {default_options.dns_cache_ttl}'))
+    parser.add_argument(
+        '--keepalive-timeout',
+        default=default_options.keepalive_timeout,
+        type=float,
+        help=(f'Idle keep-alive connection timeout (seconds). '
+              f'Default: {default_options.keepalive_timeout}'))
+    parser.add_argument('--connect-timeout',
+                        default=default_options.connect_timeout,
+                        type=float,
+                        help=(f'Connect timeout (seconds). '
+                              f'Default: {default_options.connect_timeout}'))
+    parser.add_argument('--read-timeout',
+                        default=default_options.read_timeout,
+                        type=float,
+                        help=(f'Socket read timeout (seconds). '
+                              f'Default: {default_options.read_timeout}'))
+    default_retry = RetryPolicy()
+    parser.add_argument('--retries',
+                        default=default_retry.attempts,
+                        type=int,
+                        help=(f'Retry count for 429/5xx/network errors. '
+                              f'Default: {default_retry.attempts}'))
+    parser.add_argument('--retry-base-delay',
+                        default=default_retry.base_delay,
+                        type=float,
+                        help=(f'First retry backoff (seconds), doubled '
+                              f'every attempt. '
+                              f'Default: {default_retry.base_delay}'))
+    parser.add_argument('--retry-max-delay',
+                        default=default_retry.max_delay,
+                        type=float,
+                        help=(f'Max retry backoff (seconds). '
+                              f'Default: {default_retry.max_delay}'))
+    parser.add_argument('--fixed-concurrency',
+                        action='store_true',
+                        default=False,
+                        help=('Keep --thread-count downloads in flight '
+                              'instead of adapting to errors and latency'))
+    parser.add_argument('--manifest',
+                        default=None,
+                        help=('SQLite file with download statuses, '
+                              'finished photos are skipped without a stat'))
+    parser.add_argument('--retry-failed',
+                        action='store_true',
+                        default=False,
+                        help='Download only photos failed in --manifest')
+    parser.add_argument('--dedup',
+                        action='store_true',
+                        default=False,
+                        help=('Download the same photo once and hardlink '
+                              'duplicates (by url and by content)'))
+    parser.add_argument('--order',
+                        default=DownloadOrder.WALK.value,
+                        choices=[order.value for order in DownloadOrder],
+                        help=('Download order: walk - as found, newest - '
+                              'latest messages first, dialog - dialog by '
+                              'dialog, authors - --priority-author first. '
+                              'Default: walk'))
+    parser.add_argument('--priority-author',
+                        action='append',
+                        default=[],
+                        help=('Author downloaded first with --order '
+                              'authors, can be repeated'))
+    parser.add_argument('--max-bandwidth',
+                        default=None,
+                        type=byte_size_arg,
+                        help=('Total download speed cap, bytes per second '
+                              'with an optional K/M/G suffix (e.g. 5M)'))
+    parser.add_argument('--size-variant',
+                        default=SizeVariant.ALL.value,
+                        choices=[variant.value for variant in SizeVariant],
+                        help=('Which size of a photo linked in several '
+                              'sizes to download: all, largest, smallest, '
+                              'fit - largest within --max-dimension. '
+                              'Default: all'))
+    parser.add_argument('--max-dimension',
+                        default=0,
+                        type=int,
+                        help='Max photo width/height for --size-variant fit')
+    parser.add_argument('--archive',
+                        default=None,
+                        choices=[archive.value for archive in ArchiveFormat],
+                        help=('Pack photos into tar/zip shards with an '
+                              'index in every photo dir instead of '
+                              'separate files'))
+    parser.add_argument('--archive-shard-size',
+                        default=ARCHIVE_SHARD_SIZE,
+                        type=byte_size_arg,
+                        help=('Max shard size in bytes, K/M/G suffix '
+                              'allowed. Default: 1G'))
+    parser.add_argument('--verify',
+                        action='store_true',
+                        default=False,
+                        help=('Check saved photos first (size from '
+                              '--manifest, JPEG markers) and download '
+                              'the broken ones again'))
+    parser.add_argument('--verify-hash',
+                        action='store_true',
+                        default=False,
+                        help='--verify and compare sha256 stored in --manifest')
+    parser.add_argument('--verify-workers',
+                        default=None,
+                        type=int,
+                        help='Verify process count. Default: cpu count')
+    parser.add_argument('--disk-writers',
+                        default=DISK_WRITERS,
+                        type=int,
+                        help=(f'Threads writing photos to disk. '
+                              f'Default: {DISK_WRITERS}'))
+    parser.add_argument('--fsync',
+                        default=FsyncPolicy.NONE.value,
+                        choices=[policy.value for policy in FsyncPolicy],
+                        help=('Durability: none - leave it to the OS, '
+                              'file - sync every photo, full - also sync '
+                              'its dir. Default: none'))
+    parser.add_argument('--parse-workers',
+                        default=None,
+                        type=int,
+                        help=('Html parse process count. '
+                              'Default: cpu count'))
+    parser.add_argument('--discovery-workers',
+                        default=DISCOVERY_WORKERS,
+                        type=int,
+                        help=(f'Threads scanning dump directories. '
+                              f'Default: {DISCOVERY_WORKERS}'))
+    parser.add_argument('--split-parse-size',
+                        default=SPLIT_PARSE_SIZE,
+                        type=byte_size_arg,
+                        help=('Dialogs bigger than this are split by '
+                              'messages and parsed by all --parse-workers. '
+                              'K/M/G suffix allowed. Default: 8M'))
+    parser.add_argument('--parse-cache',
+                        default=None,
+                        help=('SQLite file with parsed links, unchanged '
+                              'html files are not parsed again'))
+    parser.add_argument('--streaming-parse',
+                        action='store_true',
+                        default=False,
+                        help=('Parse html by chunks without building '
+                              'a full tree (constant memory)'))
+    parser.add_argument('--pipeline',
+                        action='store_true',
+                        default=False,
+                        help='Start downloading while html is still parsed')
+    parser.add_argument('--metrics-json',
+                        default=None,
+                        help='Write a JSON metrics summary to this file')
+    parser.add_argument('--metrics-prometheus',
+                        default=None,
+                        help='Write metrics as a Prometheus textfile')
+    parser.add_argument('--metrics-interval',
+                        default=0,
+                        type=float,
+                        help=('Also write metrics every N seconds while '
+                              'running. Default: only at the end'))
+    parser.add_argument('--profile-parse',
+                        default=None,
+                        help=('Dir for cProfile stats of every parsed '
+                              'file (*.prof, see pstats)'))
+    parser.add_argument('--watch',
+                        action='store_true',
+                        default=False,
+                        help=('Keep watching the targets and download from '
+                              'new dump files as soon as they are written'))
+    parser.add_argument('--watch-settle',
+                        default=WATCH_SETTLE,
+                        type=float,
+                        help=(f'Seconds a file must stay unchanged to be '
+                              f'parsed in --watch mode. '
+                              f'Default: {WATCH_SETTLE}'))
+    parser.add_argument('--watch-poll-interval',
+                        default=WATCH_POLL_INTERVAL,
+                        type=float,
+                        help=(f'Rescan period (seconds) in --watch mode '
+                              f'when inotify is not available. '
+                              f'Default: {WATCH_POLL_INTERVAL}'))
+    parser.add_argument('--watch-idle-exit',
+                        default=0,
+                        type=float,
+                        help=('Stop --watch after N seconds without new '
+                              'files. Default: watch until Ctrl+C'))
+    plan_group = parser.add_mutually_exclusive_group()
+    plan_group.add_argument('--plan',
+                            default=None,
+                            help=('Only parse and write download jobs '
+                                  'to this JSONL file'))
+    plan_group.add_argument('--fetch',
+                            default=None,
+                            help=('Download jobs from a --plan JSONL file '
+                                  '(targets are not needed)'))
+    parser.add_argument('--shard',
+                        default=None,
+                        type=shard_arg,
+                        help=('Fetch only shard I of N jobs ("I/N", '
+                              '1-based), stable across machines'))
+    args = parser.parse_args()
+    if not args.target_dir_file_path and not args.targets_file \
+            and not args.fetch:
+        parser.error('one of -t, --targets-file or --fetch is required')
+    if args.shard and not args.fetch:
+        parser.error('--shard works with --fetch only')
+    if args.retry_failed and not args.manifest:
+        parser.error('--retry-failed needs the failures stored in '
+                     '--manifest')
+    if args.verify_hash and not args.manifest:
+        parser.error('--verify-hash needs the hashes stored in --manifest')
+    if args.disk_writers < 1:
+        parser.error('--disk-writers must be at least 1')
+    if args.size_variant == SizeVariant.FIT.value and \
+            args.max_dimension <= 0:
+        parser.error('--size-variant fit needs a positive --max-dimension')
+    if args.archive and args.dedup:
+        parser.error('--dedup hardlinks files, it can\'t be used with '
+                     '--archive')
+    if (args.verify or args.verify_hash) and \
+            (args.pipeline or args.watch or args.plan):
+        parser.error('--verify can\'t be used with --pipeline, --watch '
+                     'or --plan')
+    if args.watch and (args.plan or args.fetch):
+        parser.error('--watch can\'t be used with --plan or --fetch')
+    if args.order == DownloadOrder.AUTHORS.value and \
+            not args.priority_author:
+        parser.error('--order authors needs at least one --priority-author')
+    return args
+
+
+def shard_arg(value: str) -> Tuple[int, int]:
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError as err:
+        raise ArgumentTypeError('shard must look like I/N') from err
+    if not 1 <= index <= count:
+        raise ArgumentTypeError('shard must be 1 <= I <= N')
+    return index, count
+
+
+def byte_size_arg(value: str) -> int:
+    multiplier = 1
+    suffix = value[-1:].upper()
+    if suffix in SIZE_SUFFIXES:
+        multiplier = SIZE_SUFFIXES[suffix]
+        value = value[:-1]
+    try:
+        size = int(float(value) * multiplier)
+    except ValueError as err:
+        raise ArgumentTypeError('size must look like 500K or 5M') from err
+    if size <= 0:
+        raise ArgumentTypeError('size must be positive')
+    return size
+
+
+def read_targets(args) -> List[str]:
+    targets = list(args.target_dir_file_path)
+    if args.targets_file:
+        with open(args.targets_file, encoding='utf-8') as file:
+            targets.extend(line.strip() for line in file
+                           if line.strip() and not line.startswith('#'))
+    return list(dict.fromkeys(targets))
+
+
+def export_metrics(metrics: Metrics, args):
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json)
+    if args.metrics_prometheus:
+        metrics.write_prometheus(args.metrics_prometheus)
+
+
+async def export_metrics_periodically(metrics: Metrics, args):
+    while True:
+        await asyncio.sleep(args.metrics_interval)
+        export_metrics(metrics, args)
 
 
 async def amain():
     args = arg_parser()
-    target = args.target_dir_file_path
-    is_manual_file = Extractor.is_input_html_file(target)
-    extractor = Extractor(args.thread_count,
-                          include_attachment_girls=args.attachment_girls,
-                          include_attachment_boys=args.attachment_boys,
-                          include_chat_with_girls=args.chat_girls,
-                          include_chat_with_boys=args.chat_boys,
-                          manual_file=is_manual_file,
-                          attachment_path_name=args.attachment_dir_name,
-                          chat_path_name=args.dialog_dir_name,
-                          girls_dir=args.girl_dir_name,
-                          boys_dir=args.boy_dir_name,
-                          photo_file_name=args.photo_file_name)
-    files = extractor.get_files(target, is_manual_file)
-    await extractor.download_from_html_files(files)
+    metrics = Metrics()
+    manifest = DownloadManifest(args.manifest) if args.manifest else None
+    parse_cache = ParseCache(args.parse_cache) if args.parse_cache else None
+    download_options = dict(
+        connection_options=ConnectionOptions(
+            total_limit=args.total_connections,
+            per_host_limit=args.per_host_limit,
+            dns_cache_ttl=args.dns_cache_ttl,
+            keepalive_timeout=args.keepalive_timeout,
+            connect_timeout=args.connect_timeout,
+            read_timeout=args.read_timeout),
+        retry_policy=RetryPolicy(args.retries, args.retry_base_delay,
+                                 args.retry_max_delay),
+        adaptive_concurrency=not args.fixed_concurrency,
+        manifest=manifest,
+        retry_failed=args.retry_failed,
+        dedup=args.dedup,
+        metrics=metrics,
+        disk_writer=DiskWriter(args.disk_writers,
+                               fsync=FsyncPolicy(args.fsync)),
+        priority=JobPriority(DownloadOrder(args.order),
+                             args.priority_author),
+        bandwidth=TokenBucket(args.max_bandwidth)
+        if args.max_bandwidth else None,
+        variant_policy=VariantPolicy(SizeVariant(args.size_variant),
+                                     args.max_dimension),
+        archive=ArchiveOutput(ArchiveFormat(args.archive),
+                              args.archive_shard_size,
+                              FsyncPolicy(args.fsync))
+        if args.archive else None,
+        verify=VerifyOptions(args.verify_workers, args.verify_hash)
+        if args.verify or args.verify_hash else None)
+    if args.profile_parse:
+        os.makedirs(args.profile_parse, exist_ok=True)
+    periodic_export = None
+    if args.metrics_interval > 0:
+        periodic_export = asyncio.ensure_future(
+            export_metrics_periodically(metrics, args))
+    try:
+        if args.fetch:
+            downloader = Downloader(args.thread_count, **download_options)
+            await downloader.download_plan(args.fetch, args.shard)
+            return
+        targets = read_targets(args)
+        manual_targets = {
+            target: Extractor.is_input_html_file(target)
+            for target in targets
+        }
+        extractor = Extractor(args.thread_count,
+                              parse_workers=args.parse_workers,
+                              parse_cache=parse_cache,
+                              **download_options,
+                              include_attachment_girls=args.attachment_girls,
+                              include_attachment_boys=args.attachment_boys,
+                              include_chat_with_girls=args.chat_girls,
+                              include_chat_with_boys=args.chat_boys,
+                              manual_file=all(manual_targets.values()),
+                              streaming_parse=args.streaming_parse,
+                              profile_dir=args.profile_parse,
+                              discovery_workers=args.discovery_workers,
+                              split_parse_size=args.split_parse_size,
+                              attachment_path_name=args.attachment_dir_name,
+                              chat_path_name=args.dialog_dir_name,
+                              girls_dir=args.girl_dir_name,
+                              boys_dir=args.boy_dir_name,
+                              photo_file_name=args.photo_file_name)
+        if args.watch:
+            if any(manual_targets.values()):
+                raise ValueError('Watch mode needs dump dirs, not html files')
+            await extractor.watch_dumps(targets, args.watch_settle,
+                                        args.watch_poll_interval,
+                                        args.watch_idle_exit)
+            return
+        dumps = {
+            target: extractor.get_files(target, is_manual)
+            for target, is_manual in manual_targets.items()
+        }
+        if args.plan:
+            extractor.plan_dumps(dumps, args.plan)
+        else:
+            await extractor.download_from_dumps(dumps, args.pipeline)
+    finally:
+        if periodic_export is not None:
+            periodic_export.cancel()
+        export_metrics(metrics, args)
+        if manifest is not None:
+            manifest.close()
+        if parse_cache is not None:
+            parse_cache.close()
 
 
 def main():
@@ -547,3 +800,7 @@ def main():
 
 if __name__ == '__main__':
     main()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,577 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import time
+from multiprocessing import Pool as ProcessPool
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import aiohttp
+from tqdm.asyncio import tqdm
+
+from .archive import ArchiveOutput
+from .jobs import (Image, JobIndex, JobPriority, JobStore, LinkRecord,
+                   VariantPolicy, shard_of)
+from .metrics import Metrics
+from .network import (DOWNLOAD_CHUNK_SIZE, ConcurrencyController,
+                      ConnectionOptions, HostLimiter, HttpStatusError,
+                      RetryPolicy, TokenBucket, parse_retry_after,
+                      url_host)
+from .storage import (Deduplicator, DiskWriter, DownloadManifest, PhotoCheck,
+                      VerifyOptions, check_photo_at, file_sha256, hardlink)
+
+VALID_PICTURE_TRAIL = ['.jpg', '.jpeg']
+HOST_STATS_TOP = 10
+VERIFY_CHUNK_SIZE = 256
+
+
+class Downloader:
+    def __init__(self,
+                 thread_count,
+                 connection_options: Optional[ConnectionOptions] = None,
+                 retry_policy: Optional[RetryPolicy] = None,
+                 adaptive_concurrency: bool = True,
+                 manifest: Optional[DownloadManifest] = None,
+                 retry_failed: bool = False,
+                 dedup: bool = False,
+                 metrics: Optional[Metrics] = None,
+                 disk_writer: Optional[DiskWriter] = None,
+                 priority: Optional[JobPriority] = None,
+                 bandwidth: Optional[TokenBucket] = None,
+                 variant_policy: Optional[VariantPolicy] = None,
+                 archive: Optional[ArchiveOutput] = None,
+                 verify: Optional[VerifyOptions] = None):
+        if retry_failed and manifest is None:
+            raise ValueError('Retry failed mode requires a manifest')
+        if dedup and archive is not None:
+            raise ValueError('Hardlink dedup does not work with archives')
+        self._header = {
+            'Accept':
+            'text/html,application/xhtml+xml,'
+            'application/xml;q=0.9,image/webp,image/apng,'
+            '*/*;q=0.8,application/signed-exchange;v=b3;q=0.9',
+            'Accept-Encoding':
+            'gzip, deflate, br',
+            'User-Agent':
+            'Mozilla/5.0 (Windows NT 6.1; Win64; x64) '
+            'AppleWebKit/537.36 (KHTML, like Gecko) '
+            'Chrome/80.0.3987.149 Safari/537.36'
+        }
+        self._thread_count = thread_count
+        self._connection_options = connection_options or ConnectionOptions()
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._concurrency = ConcurrencyController(thread_count,
+                                                  adaptive_concurrency)
+        self._metrics = metrics or Metrics()
+        self._manifest = manifest
+        self._retry_failed = retry_failed
+        self._jobs = JobStore()
+        self._paths = JobIndex(lambda index: self._jobs.image(index).path)
+        self._deduplicator = Deduplicator(self._jobs,
+                                          manifest) if dedup else None
+        self._disk_writer = disk_writer or DiskWriter()
+        self._priority = priority or JobPriority()
+        self._bandwidth = bandwidth
+        self._variant_policy = variant_policy or VariantPolicy()
+        self._archive = archive
+        self._verify = verify
+        # self._link_set = set()  # deprecated
+        self._plan_links = []
+        self._session = None
+
+    @property
+    def total_count(self):
+        return self._jobs.queued_count
+
+    @property
+    def host_stats(self):
+        return self._metrics.hosts
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    def _create_session(self):
+        options = self._connection_options
+        connector = aiohttp.TCPConnector(
+            limit=options.total_limit or self._thread_count,
+            limit_per_host=options.per_host_limit,
+            ttl_dns_cache=options.dns_cache_ttl,
+            keepalive_timeout=options.keepalive_timeout)
+        timeout = aiohttp.ClientTimeout(total=None,
+                                        connect=options.connect_timeout,
+                                        sock_read=options.read_timeout)
+        return aiohttp.ClientSession(headers=self._header,
+                                     connector=connector,
+                                     timeout=timeout)
+
+    @staticmethod
+    def _content_range_total(resp) -> Optional[int]:
+        total = resp.headers.get('Content-Range', '').rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+
+    @staticmethod
+    def _expected_size(resp, offset) -> Optional[int]:
+        if resp.headers.get('Content-Encoding') or resp.content_length is None:
+            return None
+        return offset + resp.content_length
+
+    async def _stream_to_part(self, img: Image, offset: int):
+        headers = {'Range': f'bytes={offset}-'} if offset else None
+        started = time.monotonic()
+        async with self._session.get(img.url, headers=headers) as resp:
+            if resp.status == 416 and \
+                    self._content_range_total(resp) == offset:
+                return 0, offset
+            if resp.status not in (200, 206):
+                if resp.status == 416:
+                    os.remove(img.part_path)
+                raise HttpStatusError(
+                    img.url, resp.status,
+                    parse_retry_after(resp.headers.get('Retry-After')))
+            self._concurrency.on_response(time.monotonic() - started)
+            if resp.status == 200:
+                offset = 0
+            expected_size = self._expected_size(resp, offset)
+            received = 0
+            handle = await self._disk_writer.open(img.part_path,
+                                                  append=bool(offset))
+            try:
+                async for chunk in self._iter_body(resp):
+                    await self._disk_writer.write(handle, chunk)
+                    received += len(chunk)
+            finally:
+                await self._disk_writer.close(handle)
+            self._check_size(img, offset + received, expected_size)
+            return received, offset + received
+
+    async def _download_to_memory(self, img: Image) -> bytes:
+        """The whole photo for the archive output, not resumable."""
+        started = time.monotonic()
+        async with self._session.get(img.url) as resp:
+            if resp.status != 200:
+                raise HttpStatusError(
+                    img.url, resp.status,
+                    parse_retry_after(resp.headers.get('Retry-After')))
+            self._concurrency.on_response(time.monotonic() - started)
+            expected_size = self._expected_size(resp, 0)
+            data = b''.join([chunk async for chunk in self._iter_body(resp)])
+            self._check_size(img, len(data), expected_size)
+            return data
+
+    async def _iter_body(self, resp):
+        async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            yield chunk
+            if self._bandwidth is not None:
+                await self._bandwidth.consume(len(chunk))
+
+    @staticmethod
+    def _check_size(img: Image, size: int, expected_size: Optional[int]):
+        if expected_size is not None and size != expected_size:
+            raise aiohttp.ClientPayloadError(
+                f'{img.url} got {size} of {expected_size} bytes')
+
+    async def _sha256(self, img: Image, data: Optional[bytes]) -> str:
+        if data is not None:
+            return hashlib.sha256(data).hexdigest()
+        return await asyncio.get_running_loop().run_in_executor(
+            None, file_sha256, img.path)
+
+    def _is_saved(self, img: Image) -> bool:
+        if self._archive is not None:
+            return self._archive.contains(img)
+        return os.path.isfile(img.path)
+
+    @staticmethod
+    def _is_retryable(err: Exception) -> bool:
+        if isinstance(err, HttpStatusError):
+            return err.retryable
+        return isinstance(err, (aiohttp.ClientError, TimeoutError))
+
+    @staticmethod
+    def _is_congestion(err: Exception) -> bool:
+        if isinstance(err, HttpStatusError):
+            return err.throttled or err.status >= 500
+        return True
+
+    async def save_photo(self, img: Image):
+        """Stream the photo into ``<path>.part`` and rename it when done.
+
+        A part file left by an interrupted run is resumed with a Range
+        request, so only complete files ever appear at ``img.path``.
+        Transient failures are retried by ``retry_policy`` and resume
+        from the part file as well. With a manifest, finished photos are
+        skipped by a db lookup instead of a stat call. With an archive
+        output the photo is downloaded in memory and appended to a shard.
+        """
+        if self._manifest is not None:
+            if self._manifest.is_done(img):
+                return None
+            if self._is_saved(img):
+                self._manifest.mark_done(img, None)
+                return None
+        elif self._is_saved(img):
+            return None
+        stats = self._metrics.hosts[url_host(img.url)]
+        stats.requests += 1
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                async with self._concurrency:
+                    if self._archive is not None:
+                        data = await self._download_to_memory(img)
+                        received = size = len(data)
+                    else:
+                        data = None
+                        try:
+                            offset = os.path.getsize(img.part_path)
+                        except OSError:
+                            offset = 0
+                        received, size = await self._stream_to_part(
+                            img, offset)
+                    stats.bytes += received
+                if self._archive is not None:
+                    await self._disk_writer.call(img.file_dir,
+                                                 self._archive.add, img,
+                                                 data)
+                else:
+                    await self._disk_writer.replace(img.part_path, img.path)
+                sha256 = None
+                if self._deduplicator is not None:
+                    sha256 = await self._deduplicator.dedup_content(img.path)
+                elif self._manifest is not None:  # for --verify-hash
+                    sha256 = await self._sha256(img, data)
+                if self._manifest is not None:
+                    self._manifest.mark_done(img, size, sha256)
+                return False
+            except (aiohttp.ClientError, OSError, TimeoutError) as err:
+                retry_after = getattr(err, 'retry_after', None)
+                retryable = self._is_retryable(err)
+                if retryable and self._is_congestion(err):
+                    self._concurrency.on_congestion()
+                if not retryable or attempt >= self._retry_policy.attempts:
+                    stats.errors += 1
+                    self._metrics.inc(f'error_{type(err).__name__}')
+                    print(f'{err} - {img.url}')
+                    if self._manifest is not None:
+                        self._manifest.mark_failed(img, str(err))
+                    return img
+            finally:
+                elapsed = time.monotonic() - started
+                stats.seconds += elapsed
+                stats.latency.observe(elapsed)
+            await asyncio.sleep(self._retry_policy.delay(attempt, retry_after))
+            attempt += 1
+            stats.retries += 1
+            self._metrics.inc('retries')
+
+    def _print_summary(self, skipped_count, downloaded_count, error_count):
+        print(f'Skipped file count: {skipped_count}')
+        print(f'Downloaded file count: {downloaded_count}')
+        print(f'Error file count: {error_count}')
+        if self._deduplicator is not None:
+            print(f'Deduplicated (hardlinked) file count: '
+                  f'{self._deduplicator.linked_count}')
+        busiest = sorted(self._metrics.hosts.items(),
+                         key=lambda item: item[1].requests,
+                         reverse=True)[:HOST_STATS_TOP]
+        for host, stats in busiest:
+            print(f'{host} - {stats}')
+
+    async def _download_worker(self, next_image, limiter: HostLimiter,
+                               counters: dict, progress):
+        while True:
+            img = await limiter.acquire(next_image)
+            if img is None:
+                return
+            try:
+                result = await self.save_photo(img)
+            finally:
+                limiter.release(img)
+            if result is None:
+                result_name = 'skipped'
+            elif result:
+                result_name = 'error'
+            else:
+                result_name = 'downloaded'
+            counters[result_name] += 1
+            self._metrics.inc(result_name)
+            progress.update()
+
+    async def _run_workers(self, next_image, progress, *extra_tasks):
+        """Run ``thread_count`` workers pulling images from ``next_image``.
+
+        Memory depends on the worker count only, not on the image count.
+        """
+        counters = {'skipped': 0, 'downloaded': 0, 'error': 0}
+        limiter = HostLimiter(self._connection_options.per_host_limit,
+                              self._thread_count * 4)
+        with self._metrics.timer('download'):
+            self._disk_writer.start()
+            try:
+                async with self._create_session() as self._session:
+                    await asyncio.gather(
+                        *extra_tasks, *[
+                            self._download_worker(next_image, limiter,
+                                                  counters, progress)
+                            for _ in range(self._thread_count)
+                        ])
+            finally:
+                await self._disk_writer.stop()
+                if self._archive is not None:
+                    self._archive.close()
+        if self._deduplicator is not None:
+            self._deduplicator.link_pending()
+        self._link_planned()
+        if self._manifest is not None:
+            self._manifest.commit()
+        return counters
+
+    def _link_planned(self):
+        """Hardlink the ``link_to`` jobs of a plan to their primaries."""
+        for primary_path, path in self._plan_links:
+            if not os.path.exists(path) and hardlink(primary_path, path) \
+                    and self._deduplicator is not None:
+                self._deduplicator.linked_count += 1
+        self._plan_links.clear()
+
+    def iter_queued(self) -> Iterator[Image]:
+        indices = self._jobs.iter_queued()
+        if self._priority.ordered:
+            indices = sorted(
+                indices, key=lambda index: self._priority(self._jobs.image(
+                    index)))
+        return map(self._jobs.image, indices)
+
+    async def download_files(self,
+                             images: Optional[Iterable[Image]] = None,
+                             total: Optional[int] = None):
+        """Download queued images or the given (possibly lazy) ones."""
+        if images is None:
+            images, total = self.iter_queued(), self.total_count
+        elif self._priority.ordered:
+            images = self._priority.sort(images)
+            total = len(images)
+        if self._verify is not None:
+            images = list(images)
+            total = len(images)
+            self.verify_saved(images)
+        images = iter(images)
+
+        async def next_image():
+            return next(images, None)
+
+        with tqdm(total=total) as progress:
+            counters = await self._run_workers(next_image, progress)
+        self._print_summary(counters['skipped'], counters['downloaded'],
+                            counters['error'])
+
+    def _photo_check(self, img: Image) -> Optional[PhotoCheck]:
+        saved = None if self._manifest is None else self._manifest.saved(img)
+        expected_size, sha256 = saved or (None, None)
+        if not self._verify.check_hash:
+            sha256 = None
+        recorded = saved is not None
+        if self._archive is None:
+            return PhotoCheck(img.path, None, None, expected_size, sha256,
+                              recorded)
+        location = self._archive.location(img)
+        if location is None:
+            return PhotoCheck(None, recorded=True) if recorded else None
+        return PhotoCheck(*location, expected_size, sha256, recorded)
+
+    def _discard_broken(self, img: Image, reason: str):
+        print(f'Broken {img.path}: {reason}')
+        if self._archive is not None:
+            self._archive.discard(img)
+        else:
+            try:
+                os.remove(img.path)
+            except FileNotFoundError:
+                pass
+        if self._manifest is not None:
+            self._manifest.mark_failed(img, f'verify: {reason}')
+
+    def verify_saved(self, images: List[Image]) -> int:
+        """Check saved photos in worker processes, returns broken count.
+
+        Broken photos are removed (or dropped from the archive index) and
+        the ones done in the manifest but missing are marked failed, so
+        the following download fetches only them and the missing ones.
+        """
+        checks = [(index, check)
+                  for index, check in enumerate(map(self._photo_check, images))
+                  if check is not None]
+        broken_count = 0
+        print('Start verifying saved files')
+        with self._metrics.timer('verify'), \
+                ProcessPool(self._verify.workers) as pool, \
+                tqdm(total=len(checks)) as progress:
+            for index, reason in pool.imap_unordered(
+                    check_photo_at, checks, chunksize=VERIFY_CHUNK_SIZE):
+                progress.update()
+                if reason is not None:
+                    self._discard_broken(images[index], reason)
+                    broken_count += 1
+        self._metrics.inc('verified', len(checks))
+        self._metrics.inc('verify_broken', broken_count)
+        print(f'Broken file count: {broken_count}')
+        return broken_count
+
+    def write_plan(self, plan_path: str) -> int:
+        """Dump queued images as JSONL jobs, returns the job count.
+
+        With dedup the duplicate paths follow as ``link_to`` jobs, fetch
+        hardlinks them to the downloaded primary path.
+        """
+        count = 0
+        with open(plan_path, 'w', encoding='utf-8') as file:
+            for img in self.iter_queued():
+                file.write(
+                    json.dumps(
+                        {
+                            'url': img.url,
+                            'path': img.path,
+                            'author': img.author,
+                            'date': img.date,
+                            'source': img.source_file
+                        },
+                        ensure_ascii=False) + '\n')
+                count += 1
+            if self._deduplicator is not None:
+                for primary_path, path in self._deduplicator.pending_links:
+                    file.write(
+                        json.dumps({
+                            'path': path,
+                            'link_to': primary_path
+                        },
+                                   ensure_ascii=False) + '\n')
+                    count += 1
+        return count
+
+    def read_plan(self,
+                  plan_path: str,
+                  shard: Optional[Tuple[int, int]] = None) -> \
+            Iterator[Image]:
+        with open(plan_path, encoding='utf-8') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                job = json.loads(line)
+                link_to = job.get('link_to')
+                # a link goes to the shard that downloads its primary
+                if shard is not None and shard_of(
+                        link_to or job['path'], shard[1]) != shard[0] - 1:
+                    continue
+                if link_to is not None:
+                    self._plan_links.append((link_to, job['path']))
+                    continue
+                img = Image.from_job(job['url'], job['path'],
+                                     job.get('author', ''),
+                                     job.get('date', ''),
+                                     job.get('source', ''))
+                if self._accept_planned(img):
+                    yield img
+
+    def _accept_planned(self, image: Image) -> bool:
+        """Plans are deduplicated already, so jobs are not kept in sets.
+
+        Memory of a fetch depends on the worker count, not the plan size.
+        """
+        if not self._link_validator(image.url):
+            return False
+        return not self._retry_failed or self._manifest.is_failed(image)
+
+    async def download_plan(self,
+                            plan_path: str,
+                            shard: Optional[Tuple[int, int]] = None):
+        await self.download_files(self.read_plan(plan_path, shard))
+
+    async def _feed_pipeline(self, batches: asyncio.Queue,
+                             images: asyncio.PriorityQueue, progress,
+                             worker_count):
+        order = itertools.count()
+        while True:
+            batch = await batches.get()
+            if batch is None:
+                break
+            accepted = []
+            with self._metrics.timer('filtering'):
+                for img in batch:
+                    is_new = self.accept_img(img)
+                    if is_new is False:
+                        self._metrics.inc('invalid_urls')
+                        print(f'Invalid image url: {img.url}')
+                    elif is_new:
+                        accepted.append(img)
+            progress.total += len(accepted)
+            progress.refresh()
+            for img in accepted:
+                await images.put((self._priority(img), next(order), img))
+        for _ in range(worker_count):
+            await images.put((float('inf'), next(order), None))
+
+    async def download_pipelined(self, batches: asyncio.Queue):
+        """Download images while they are still being parsed.
+
+        ``batches`` gets a list of images per parsed file and ``None``
+        after the last one. Dedup and url validation happen inline, the
+        priority order applies to the parsed jobs waiting in the queue.
+        """
+        images = asyncio.PriorityQueue(maxsize=self._thread_count * 2)
+
+        async def next_image():
+            return (await images.get())[2]
+
+        with tqdm(total=0) as progress:
+            counters = await self._run_workers(
+                next_image, progress,
+                self._feed_pipeline(batches, images, progress,
+                                    self._thread_count))
+        print(f'Valid images after filtering: {len(self._paths)}')
+        self._print_summary(counters['skipped'], counters['downloaded'],
+                            counters['error'])
+
+    @staticmethod
+    def _link_validator(url: str):
+        trailed_url = url.split('?')[0]
+        valid_head = trailed_url.startswith('http')
+        valid_trail = any(
+            trailed_url.endswith(trail) for trail in VALID_PICTURE_TRAIL)
+        return valid_head and valid_trail
+
+    def generate_image_object(self, source_file, url, author='', date=''):
+        return Image(source_file, url, author, date,
+                     self._variant_policy.variant_of(url))
+
+    def select_variants(self,
+                        records: List[LinkRecord]) -> List[LinkRecord]:
+        return self._variant_policy.select(records)
+
+    def _accept(self, image: Image) -> Tuple[Optional[bool], int]:
+        """``accept_img`` result and the job index of a new job."""
+        if not self._link_validator(image.url):
+            return False, -1
+        if self._retry_failed and not self._manifest.is_failed(image):
+            return None, -1
+        index = len(self._jobs)
+        if self._paths.setdefault(image.path, index) != index:
+            return None, -1
+        self._jobs.add(image)
+        if self._deduplicator is not None and \
+                not self._deduplicator.register(image, index):
+            return None, -1
+        return True, index
+
+    def accept_img(self, image: Image) -> Optional[bool]:
+        """None - already queued, False - invalid url, True - new one."""
+        return self._accept(image)[0]
+
+    def push_img(self, image: Image, group: str = ''):
+        """Queue the image, groups (dumps) are downloaded in turns."""
+        accepted, index = self._accept(image)
+        if accepted:
+            self._jobs.queue(index, group)
+        return accepted is not False
@@ -0,0 +1,392 @@
+import hashlib
+import os
+import re
+import sys
+from array import array
+from collections import defaultdict, deque
+from enum import Enum
+from functools import lru_cache
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+
+class SizeVariant(Enum):
+    ALL = 'all'  # every linked size, named as before
+    LARGEST = 'largest'
+    SMALLEST = 'smallest'
+    FIT = 'fit'  # largest within max dimension, else the smallest
+
+
+class LinkRecord(NamedTuple):
+    url: str
+    author: str = ''
+    date: str = ''
+
+
+PART_FILE_SUFFIX = '.part'
+CDN_SHARD_PATTERN = re.compile(r'^(?:sun|pp|cs|vkuserphoto)[\d-]*\.')
+URL_KEY_PARAMS = ('size', )
+SIZE_PARAM_PATTERN = re.compile(r'[?&]size=(\d+)x(\d+)')
+JOB_INDEX_SIZE = 1024
+JOB_INDEX_LOAD = 0.8
+UNDERSCORES_PATTERN = re.compile(r'_+')
+NON_DIGITS_PATTERN = re.compile(r'\D')
+
+
+def roundrobin(*iterables: Iterable) -> Iterator:
+    """roundrobin('AB', 'C', 'DE') -> A C D B E"""
+    iterators = deque(iter(iterable) for iterable in iterables)
+    while iterators:
+        iterator = iterators.popleft()
+        for item in iterator:
+            yield item
+            iterators.append(iterator)
+            break
+
+
+@lru_cache(maxsize=None)
+def photo_dir_of(source_file: str) -> str:
+    """Interned output dir of a source html, shared by all its images."""
+    return sys.intern(os.path.join(os.path.dirname(source_file), 'photo'))
+
+
+class Image:
+    """Download job being handled, queued ones are packed in ``JobStore``.
+
+    Source file, author, date and the output dir are interned and shared
+    between images, the file name is built on demand.
+    """
+    __slots__ = ('_source_file', '_photo_dir', '_url', '_author', '_date',
+                 '_variant', '_name')
+
+    def __init__(self, source_file, url, author='', date='', variant=''):
+        self._source_file = sys.intern(source_file)
+        self._photo_dir = photo_dir_of(source_file)
+        self._url = url
+        self._author = sys.intern(author)
+        self._date = sys.intern(date)
+        self._variant = sys.intern(variant)
+        self._name = None
+
+    @classmethod
+    def from_job(cls,
+                 url: str,
+                 path: str,
+                 author='',
+                 date='',
+                 source_file='') -> 'Image':
+        """Image with an already generated path (from a plan file)."""
+        img = cls.__new__(cls)
+        img._source_file = sys.intern(source_file)
+        img._photo_dir = sys.intern(os.path.dirname(path))
+        img._url = url
+        img._author = sys.intern(author)
+        img._date = sys.intern(date)
+        img._variant = ''
+        img._name = os.path.basename(path)
+        return img
+
+    @property
+    def source_file(self):
+        return self._source_file
+
+    @property
+    def author(self):
+        return self._author
+
+    @property
+    def date(self):
+        return self._date
+
+    @property
+    def variant(self):
+        return self._variant
+
+    @property
+    def name(self):
+        if self._name is not None:
+            return self._name
+        return self.name_generator(self._url, self._author, self._date,
+                                   self._variant)
+
+    @property
+    def path(self):
+        return os.path.join(self._photo_dir, self.name)
+
+    @property
+    def url(self):
+        return self._url
+
+    @property
+    def file_dir(self):
+        return self._photo_dir
+
+    @property
+    def part_path(self):
+        return self.path + PART_FILE_SUFFIX
+
+    @staticmethod
+    def name_generator(url, author, date, variant=''):
+        name = f'{date}_{author}_{url[url.rfind("/") + 1:]}'
+        if '__' in name:  # the regex is the slowest part, usually not needed
+            name = UNDERSCORES_PATTERN.sub('_', name)
+        name = name.partition('?')[0]
+        if variant:
+            stem, ext = os.path.splitext(name)
+            name = f'{stem}_{variant}{ext}'
+        return name
+
+    @classmethod
+    def path_generator(cls, source_file, url, author, date, variant=''):
+        return os.path.join(photo_dir_of(source_file),
+                            cls.name_generator(url, author, date, variant))
+
+
+class JobStore:
+    """Download jobs packed into arrays, ~30 bytes per queued job.
+
+    Source file (with the variant), author and date of a job are kept
+    once in a value table and referenced by index, the url is the only
+    per-job object. ``Image`` objects are built only for the
+    jobs being handled. Queued jobs are kept as runs of indices per
+    group, jobs of one html file make one run.
+    """
+    def __init__(self):
+        self._urls = []
+        self._fields = array('I')  # (source, variant), author, date ids
+        self._value_ids = {}
+        self._values = []
+        self._groups = defaultdict(lambda: array('I'))  # [start, end) runs
+        self.queued_count = 0
+
+    def __len__(self):
+        return len(self._urls)
+
+    def _value_id(self, value) -> int:
+        try:
+            return self._value_ids[value]
+        except KeyError:
+            self._values.append(value)
+            return self._value_ids.setdefault(value, len(self._values) - 1)
+
+    def add(self, img: Image) -> int:
+        """Store the job, returns its index."""
+        value_id = self._value_id
+        self._urls.append(img.url)
+        self._fields.extend(
+            (value_id((img.source_file, img.variant)), value_id(img.author),
+             value_id(img.date)))
+        return len(self._urls) - 1
+
+    def url(self, index: int) -> str:
+        return self._urls[index]
+
+    def image(self, index: int) -> Image:
+        source_id, author_id, date_id = self._fields[index * 3:index * 3 + 3]
+        source_file, variant = self._values[source_id]
+        return Image(source_file, self._urls[index], self._values[author_id],
+                     self._values[date_id], variant)
+
+    def queue(self, index: int, group: str = ''):
+        runs = self._groups[group]
+        if runs and runs[-1] == index:
+            runs[-1] = index + 1
+        else:
+            runs.extend((index, index + 1))
+        self.queued_count += 1
+
+    @staticmethod
+    def _iter_runs(runs: array) -> Iterator[int]:
+        for run in range(0, len(runs), 2):
+            yield from range(runs[run], runs[run + 1])
+
+    def iter_queued(self) -> Iterator[int]:
+        """Queued job indices, groups (dumps) take turns."""
+        return roundrobin(*map(self._iter_runs, self._groups.values()))
+
+
+class JobIndex:
+    """Hash set of job indices keyed by a string of the job.
+
+    Open addressing over two arrays, an entry takes ~10-12 bytes instead
+    of a key string and a set slot. ``key_of`` rebuilds the key of a job,
+    only to confirm a match of the 32-bit hash tags.
+    """
+    def __init__(self, key_of):
+        self._key_of = key_of
+        self._slots = array('I', bytes(4 * JOB_INDEX_SIZE))  # index + 1
+        self._tags = array('I', bytes(4 * JOB_INDEX_SIZE))
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @staticmethod
+    def _tag(key: str) -> int:
+        return hash(key) & 0xFFFFFFFF
+
+    def _probe(self, key: str, tag: int) -> Tuple[int, Optional[int]]:
+        """(slot, job index) of the key, or the free slot for it."""
+        slots, tags = self._slots, self._tags
+        size = len(slots)
+        slot = tag % size
+        while True:
+            entry = slots[slot]
+            if not entry:
+                return slot, None
+            if tags[slot] == tag and self._key_of(entry - 1) == key:
+                return slot, entry - 1
+            slot += 1
+            if slot == size:
+                slot = 0
+
+    def get(self, key: str) -> Optional[int]:
+        return self._probe(key, self._tag(key))[1]
+
+    def setdefault(self, key: str, index: int) -> int:
+        """Job index stored for the key, the given one if it is new."""
+        tag = self._tag(key)
+        slot, found = self._probe(key, tag)
+        if found is not None:
+            return found
+        self._slots[slot] = index + 1
+        self._tags[slot] = tag
+        self._count += 1
+        if self._count > len(self._slots) * JOB_INDEX_LOAD:
+            self._grow()
+        return index
+
+    def _grow(self):
+        """A quarter bigger, placed by the stored tags without any keys."""
+        old_slots, old_tags = self._slots, self._tags
+        size = len(old_slots) * 5 // 4
+        slots = self._slots = array('I', bytes(4 * size))
+        tags = self._tags = array('I', bytes(4 * size))
+        for entry, tag in zip(old_slots, old_tags):
+            if not entry:
+                continue
+            slot = tag % size
+            while slots[slot]:
+                slot = slot + 1 if slot + 1 < size else 0
+            slots[slot] = entry
+            tags[slot] = tag
+
+
+class DownloadOrder(Enum):
+    WALK = 'walk'  # as found on disk, dumps take turns
+    NEWEST = 'newest'  # latest messages first, attachments last
+    DIALOG = 'dialog'  # one dialog (html file) after another
+    AUTHORS = 'authors'  # given authors first, in the given order
+
+
+class JobPriority:
+    """Sort key of download jobs by ``order``, lower goes first.
+
+    Jobs with the same key keep the walk order.
+    """
+    def __init__(self,
+                 order: DownloadOrder = DownloadOrder.WALK,
+                 authors: Iterable[str] = ()):
+        self._order = order
+        self._author_ranks = {}
+        for author in authors:
+            self._author_ranks.setdefault(author, len(self._author_ranks))
+        self._dialog_ranks = {}
+
+    @property
+    def ordered(self) -> bool:
+        return self._order is not DownloadOrder.WALK
+
+    def __call__(self, img: Image) -> int:
+        if self._order is DownloadOrder.NEWEST:
+            return -int(NON_DIGITS_PATTERN.sub('', img.date) or 0)
+        if self._order is DownloadOrder.DIALOG:
+            dialog = img.source_file or img.file_dir
+            return self._dialog_ranks.setdefault(dialog,
+                                                 len(self._dialog_ranks))
+        if self._order is DownloadOrder.AUTHORS:
+            return self._author_ranks.get(img.author,
+                                          len(self._author_ranks))
+        return 0
+
+    def sort(self, images: Iterable[Image]) -> Iterable[Image]:
+        return sorted(images, key=self) if self.ordered else images
+
+
+def shard_of(path: str, shard_count: int) -> int:
+    """Stable (process independent) shard number of a job."""
+    digest = hashlib.md5(path.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count
+
+
+def canonical_url_key(url: str) -> str:
+    """Url without the CDN shard and the per-link query noise (sign etc)."""
+    parts = urlsplit(url)
+    host = CDN_SHARD_PATTERN.sub('', parts.hostname or '')
+    query = urlencode(
+        sorted((key, value) for key, value in parse_qsl(parts.query)
+               if key in URL_KEY_PARAMS))
+    return f'{host}{parts.path}?{query}'
+
+
+def url_size(url: str) -> Optional[Tuple[int, int]]:
+    match = SIZE_PARAM_PATTERN.search(url)
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+class VariantPolicy:
+    """Picks one size variant of a photo linked several times.
+
+    Variants are links of one message to the same picture that differ by
+    the ``size`` param only. A link without it is taken as the original
+    (the largest one). With a policy the size goes to the file name.
+    """
+    def __init__(self,
+                 variant: SizeVariant = SizeVariant.ALL,
+                 max_dimension: int = 0):
+        if variant is SizeVariant.FIT and max_dimension <= 0:
+            raise ValueError('Fit size variant needs a max dimension')
+        self._variant = variant
+        self._max_dimension = max_dimension
+
+    @property
+    def active(self) -> bool:
+        return self._variant is not SizeVariant.ALL
+
+    @staticmethod
+    def _photo_key(url: str) -> str:
+        parts = urlsplit(url)
+        return CDN_SHARD_PATTERN.sub('', parts.hostname or '') + parts.path
+
+    @staticmethod
+    def _dimension(url: str) -> float:
+        size = url_size(url)
+        return max(size) if size else float('inf')
+
+    def _better(self, url: str, other_url: str) -> bool:
+        dimension = self._dimension(url)
+        other_dimension = self._dimension(other_url)
+        if self._variant is SizeVariant.FIT:
+            fits = dimension <= self._max_dimension
+            if fits != (other_dimension <= self._max_dimension):
+                return fits
+            return dimension > other_dimension if fits else \
+                dimension < other_dimension
+        if self._variant is SizeVariant.LARGEST:
+            return dimension > other_dimension
+        return dimension < other_dimension
+
+    def select(self, records: List[LinkRecord]) -> List[LinkRecord]:
+        if not self.active:
+            return records
+        chosen = {}
+        for record in records:
+            key = (record.author, record.date, self._photo_key(record.url))
+            best = chosen.get(key)
+            if best is None or self._better(record.url, best.url):
+                chosen[key] = record
+        return list(chosen.values())
+
+    def variant_of(self, url: str) -> str:
+        size = url_size(url) if self.active else None
+        return f'{size[0]}x{size[1]}' if size else ''
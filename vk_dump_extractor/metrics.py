@@ -0,0 +1,193 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS_PREFIX = 'vk_dump_extractor'
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense."""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': dict(zip(map(str, self.buckets), self.counts))
+        }
+
+    def prometheus_lines(self, name: str, labels: str = ''):
+        prefix = labels + ',' if labels else ''
+        suffix = f'{{{labels}}}' if labels else ''
+        for bound, count in zip(self.buckets, self.counts):
+            yield f'{name}_bucket{{{prefix}le="{bound}"}} {count}'
+        yield f'{name}_bucket{{{prefix}le="+Inf"}} {self.count}'
+        yield f'{name}_sum{suffix} {self.sum}'
+        yield f'{name}_count{suffix} {self.count}'
+
+
+class HostStats:
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.latency = Histogram()
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'errors': self.errors,
+            'bytes': self.bytes,
+            'seconds': self.seconds,
+            'latency': self.latency.as_dict()
+        }
+
+    def __str__(self):
+        speed = self.bytes / self.seconds / 1024 if self.seconds else 0
+        return (f'requests: {self.requests}, retries: {self.retries}, '
+                f'errors: {self.errors}, '
+                f'{self.bytes / 1024 / 1024:.1f} MiB, '
+                f'avg {self.seconds / max(self.requests, 1):.2f}s, '
+                f'{speed:.0f} KiB/s per request')
+
+
+class Metrics:
+    """Run metrics: stage timers, event counters, parse and host latency.
+
+    Can be dumped as a JSON summary or as a Prometheus textfile. Parse
+    metrics may come from the pipeline thread, hence the lock.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self.stage_seconds = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.parse_seconds = Histogram()
+        self.hosts = defaultdict(HostStats)
+        self._running = defaultdict(list)  # stage -> timer start times
+
+    @contextmanager
+    def timer(self, stage: str):
+        """Time a stage, running timers count in exports taken meanwhile."""
+        started = time.perf_counter()
+        with self._lock:
+            self._running[stage].append(started)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._running[stage].remove(started)
+                self.stage_seconds[stage] += time.perf_counter() - started
+
+    def timed(self, stage: str, iterable: Iterable) -> Iterator:
+        """Yield from ``iterable``, only the time spent in it counts."""
+        iterator = iter(iterable)
+        end = object()
+        while True:
+            with self.timer(stage):
+                item = next(iterator, end)
+            if item is end:
+                return
+            yield item
+
+    def add_time(self, stage: str, seconds: float):
+        with self._lock:
+            self.stage_seconds[stage] += seconds
+
+    def inc(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def observe_parse(self, seconds: float):
+        with self._lock:
+            self.parse_seconds.observe(seconds)
+
+    def _stage_seconds(self) -> Dict[str, float]:
+        """Finished time of the stages plus the time of running timers."""
+        now = time.perf_counter()
+        stages = dict(self.stage_seconds)
+        for stage, starts in self._running.items():
+            if starts:
+                stages[stage] = stages.get(stage, 0) + sum(
+                    now - started for started in starts)
+        return stages
+
+    def summary(self) -> dict:
+        with self._lock:
+            stages = self._stage_seconds()
+            download_seconds = stages.get('download', 0)
+            downloaded_bytes = sum(stats.bytes
+                                   for stats in self.hosts.values())
+            return {
+                'started': self._started,
+                'elapsed': time.time() - self._started,
+                'stages': stages,
+                'counters': dict(self.counters),
+                'download_bytes_per_second':
+                (downloaded_bytes /
+                 download_seconds if download_seconds else 0),
+                'parse_file_seconds': self.parse_seconds.as_dict(),
+                'hosts': {
+                    host: stats.as_dict()
+                    for host, stats in self.hosts.items()
+                }
+            }
+
+    def _prometheus_lines(self):
+        summary = self.summary()
+        yield f'# TYPE {METRICS_PREFIX}_stage_seconds gauge'
+        for stage, seconds in summary['stages'].items():
+            yield f'{METRICS_PREFIX}_stage_seconds{{stage="{stage}"}} ' \
+                  f'{seconds}'
+        yield f'# TYPE {METRICS_PREFIX}_events_total counter'
+        for name, value in summary['counters'].items():
+            yield f'{METRICS_PREFIX}_events_total{{event="{name}"}} {value}'
+        yield f'# TYPE {METRICS_PREFIX}_download_bytes_per_second gauge'
+        yield (f'{METRICS_PREFIX}_download_bytes_per_second '
+               f'{summary["download_bytes_per_second"]}')
+        yield f'# TYPE {METRICS_PREFIX}_parse_file_seconds histogram'
+        with self._lock:
+            yield from self.parse_seconds.prometheus_lines(
+                f'{METRICS_PREFIX}_parse_file_seconds')
+        hosts = list(self.hosts.items())
+        for name in ('requests', 'retries', 'errors', 'bytes'):
+            yield f'# TYPE {METRICS_PREFIX}_host_{name}_total counter'
+            for host, stats in hosts:
+                yield (f'{METRICS_PREFIX}_host_{name}_total{{host="{host}"}} '
+                       f'{getattr(stats, name)}')
+        yield f'# TYPE {METRICS_PREFIX}_host_request_seconds histogram'
+        for host, stats in hosts:
+            yield from stats.latency.prometheus_lines(
+                f'{METRICS_PREFIX}_host_request_seconds', f'host="{host}"')
+
+    @staticmethod
+    def _write_atomic(path: str, text: str):
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write(text)
+        os.replace(temp_path, path)
+
+    def write_json(self, path: str):
+        self._write_atomic(path, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, path: str):
+        self._write_atomic(path, '\n'.join(self._prometheus_lines()) + '\n')
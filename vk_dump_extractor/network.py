@@ -0,0 +1,214 @@
+import asyncio
+import random
+import time
+from collections import defaultdict, deque
+from email.utils import parsedate_to_datetime
+from typing import NamedTuple, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from .jobs import Image
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+RETRYABLE_STATUSES = {408, 416, 425, 429}
+LATENCY_SPIKE_RATIO = 3
+LATENCY_SPIKE_FLOOR = 0.5
+
+
+class TokenBucket:
+    """Global bandwidth cap, ``rate`` bytes per second.
+
+    Consumers reserve bytes in arrival order and sleep off the debt, so a
+    burst of up to ``capacity`` bytes passes without waiting.
+    """
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self._rate = rate
+        self._capacity = capacity or max(rate, DOWNLOAD_CHUNK_SIZE)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    async def consume(self, amount: int):
+        now = time.monotonic()
+        self._tokens = min(self._capacity,
+                           self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        self._tokens -= amount
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self._rate)
+
+
+class ConnectionOptions(NamedTuple):
+    """aiohttp connector settings, zero limits mean "same as workers"."""
+    total_limit: int = 0
+    per_host_limit: int = 0
+    dns_cache_ttl: int = 300
+    keepalive_timeout: float = 30
+    connect_timeout: float = 30
+    read_timeout: float = 60
+
+
+def url_host(url: str) -> str:
+    return urlsplit(url).hostname or ''
+
+
+class HostLimiter:
+    """Per-host concurrency caps without head-of-line blocking.
+
+    An image whose host is saturated is parked in a per-host backlog and
+    the worker takes the next one, so a slow shard can hold at most
+    ``per_host_limit`` workers. The backlog is capped by ``max_backlog``.
+    """
+    def __init__(self, per_host_limit: int, max_backlog: int):
+        self._limit = per_host_limit
+        self._max_backlog = max_backlog
+        self._active = defaultdict(int)
+        self._backlog = defaultdict(deque)
+        self._backlog_size = 0
+        self._exhausted = False
+        self._released = asyncio.Event()
+
+    def _pop_ready(self) -> Optional[Image]:
+        for host, images in self._backlog.items():
+            if self._active[host] < self._limit:
+                img = images.popleft()
+                if not images:
+                    del self._backlog[host]
+                self._backlog_size -= 1
+                self._active[host] += 1
+                return img
+        return None
+
+    async def acquire(self, next_image) -> Optional[Image]:
+        """Next image with its host slot taken, None when all are done."""
+        if not self._limit:
+            return await next_image()
+        while True:
+            img = self._pop_ready()
+            if img is not None:
+                return img
+            if not self._exhausted and \
+                    self._backlog_size < self._max_backlog:
+                img = await next_image()
+                if img is None:
+                    self._exhausted = True
+                    continue
+                host = url_host(img.url)
+                if self._active[host] < self._limit:
+                    self._active[host] += 1
+                    return img
+                self._backlog[host].append(img)
+                self._backlog_size += 1
+                continue
+            if self._exhausted and not self._backlog_size:
+                return None
+            released = self._released
+            await released.wait()
+
+    def release(self, img: Image):
+        if not self._limit:
+            return
+        self._active[url_host(img.url)] -= 1
+        self._released.set()
+        self._released = asyncio.Event()
+
+
+class HttpStatusError(aiohttp.ClientError):
+    def __init__(self, url: str, status: int, retry_after: Optional[float]):
+        super().__init__(f'{url} return code {status} (not 200)')
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self):
+        return self.status in RETRYABLE_STATUSES or self.status >= 500
+
+    @property
+    def throttled(self):
+        return self.status in (429, 503)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy(NamedTuple):
+    """Exponential backoff with full jitter, Retry-After wins if sent."""
+    attempts: int = 3
+    base_delay: float = 1
+    max_delay: float = 60
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None):
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+class ConcurrencyController:
+    """In-flight download limit, AIMD-adapted when ``adaptive``.
+
+    A healthy response grows the limit by ``1 / limit`` (about +1 per
+    round of requests). Throttling, errors and time-to-first-byte spikes
+    halve it, not more often than once per ``cooldown`` seconds.
+    """
+    def __init__(self, max_limit: int, adaptive=True, cooldown=1.0):
+        self._max_limit = max(1, max_limit)
+        self._adaptive = adaptive
+        self._limit = float(
+            max(1, self._max_limit // 4) if adaptive else self._max_limit)
+        self._cooldown = cooldown
+        self._in_flight = 0
+        self._latency = None
+        self._best_latency = None
+        self._last_decrease = 0.0
+        self._changed = asyncio.Event()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def __aenter__(self):
+        while self._in_flight >= int(self._limit):
+            await self._changed.wait()
+        self._in_flight += 1
+
+    async def __aexit__(self, *exc_info):
+        self._in_flight -= 1
+        self._notify()
+
+    def on_response(self, latency: float):
+        if not self._adaptive:
+            return
+        self._latency = (latency if self._latency is None else
+                         0.8 * self._latency + 0.2 * latency)
+        self._best_latency = min(self._best_latency or self._latency,
+                                 self._latency)
+        if self._latency > max(self._best_latency * LATENCY_SPIKE_RATIO,
+                               LATENCY_SPIKE_FLOOR):
+            self.on_congestion()
+            return
+        self._limit = min(self._max_limit, self._limit + 1 / self._limit)
+        self._notify()
+
+    def on_congestion(self):
+        now = time.monotonic()
+        if not self._adaptive or now - self._last_decrease < self._cooldown:
+            return
+        self._last_decrease = now
+        self._limit = max(1.0, self._limit / 2)
@@ -0,0 +1,573 @@
+import cProfile
+import json
+import mmap
+import os
+import re
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from enum import Enum, auto
+from html import unescape
+from html.parser import HTMLParser
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from bs4 import BeautifulSoup
+
+from .downloader import Downloader
+from .jobs import Image, LinkRecord
+
+
+class HtmlTypeDoc(Enum):
+    PHOTOS_ONLY = auto()
+    DIALOG = auto()
+
+
+class ParserMode(Enum):
+    TARGET_FILE = auto()
+    AUTO_SEARCH = auto()
+
+
+DirContext = Tuple[Optional[HtmlTypeDoc], Optional[HtmlTypeDoc]]
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+PARSE_CACHE_VERSION = 1
+DISCOVERY_WORKERS = 8
+TITLE_SNIFF_SIZE = 8 * 1024
+TITLE_PATTERN = re.compile(r'<title[^>]*>(.*?)</title>', re.I | re.S)
+
+
+def get_soup(html_file_path):
+    return BeautifulSoup(html_file_path, 'html.parser')
+
+
+class FileChecker:
+    def __init__(self,
+                 common_title='Общий лист фотографий',
+                 photo_html_name='photos.html',
+                 dialog_pattern=r'history_.\d*\.htm'):
+        self._common_title = common_title
+        self._photo_html = photo_html_name
+        self._dialog_pattern = dialog_pattern
+
+    @staticmethod
+    def _sniff_title(file_path: str) -> Tuple[bool, Optional[str]]:
+        """(found, title) from the file head, without parsing the file."""
+        with open(file_path, 'rb') as file:
+            head = file.read(TITLE_SNIFF_SIZE)
+        text = head.decode('utf-8', errors='ignore')
+        match = TITLE_PATTERN.search(text)
+        if match:
+            return True, unescape(match.group(1))
+        finished = len(head) < TITLE_SNIFF_SIZE or '<body' in text.lower()
+        return finished, None
+
+    def check_by_html(self, file_path: str) -> Optional[HtmlTypeDoc]:
+        found, title = self._sniff_title(file_path)
+        if not found:
+            with open(file_path, encoding='utf-8') as file:
+                soup = get_soup(file)
+            title = soup.title and soup.title.text
+        if title is None:
+            return None
+        if title == self._common_title:
+            return HtmlTypeDoc.PHOTOS_ONLY
+        return HtmlTypeDoc.DIALOG
+
+    def check_by_file_name(self, file_path: str,
+                           need_to_check_file=False) -> \
+            Optional[HtmlTypeDoc]:
+        file_name = os.path.basename(file_path)
+        if file_name == self._photo_html:
+            return HtmlTypeDoc.PHOTOS_ONLY
+        if re.search(self._dialog_pattern, file_name):
+            return HtmlTypeDoc.DIALOG
+        if need_to_check_file:
+            return self.check_by_html(file_path)
+        return None
+
+
+class HtmlFile:
+    def __init__(self, file_path: str, file_type: HtmlTypeDoc):
+        self._file_path = file_path
+        self._file_type = file_type
+
+    @property
+    def is_htm(self):
+        return not self._file_path.endswith('html')
+
+    @property
+    def filename(self):
+        return os.path.basename(self._file_path)
+
+    @property
+    def file_path(self):
+        return self._file_path
+
+    @property
+    def file_type(self):
+        return self._file_type
+
+
+def _has_class(attrs: dict, class_name: str) -> bool:
+    return class_name in (attrs.get('class') or '').split()
+
+
+def _format_message_date(str_date: str) -> str:
+    date_time = datetime.strptime(str_date, '%d.%m.%Y %H:%M')
+    return date_time.strftime('[%Y-%m-%d_%H-%M]')
+
+
+class StreamingLinkParser(HTMLParser):
+    """Event-driven counterpart of the BeautifulSoup based collector.
+
+    Only the state of the current ``im_in`` message is kept, finished
+    records are pushed to ``records`` and should be drained by the caller
+    after every ``feed``. With ``container=None`` (attachment files) every
+    matching link is a record on its own.
+    """
+    def __init__(self, container: Optional[str], a_class: Optional[str]):
+        super().__init__(convert_charrefs=True)
+        self._container = container
+        self._a_class = a_class
+        self.records = deque()
+        self._depth = 0
+        self._reset_message()
+
+    def _reset_message(self):
+        self._urls = []
+        self._author = None
+        self._date = None
+        self._capture = None
+        self._capture_depth = 0
+        self._text = []
+
+    def _is_photo_link(self, tag, attrs):
+        return (tag == 'a' and 'href' in attrs
+                and (self._a_class is None or _has_class(attrs, self._a_class)))
+
+    def _start_capture(self, tag, attrs):
+        if self._capture is not None:
+            if tag == self._capture[0]:
+                self._capture_depth += 1
+            return
+        if (self._author is None and tag == 'div'
+                and _has_class(attrs, 'im_log_author_chat_name')):
+            self._capture = (tag, 'author')
+        elif (self._date is None and tag == 'a'
+              and _has_class(attrs, 'im_date_link')):
+            self._capture = (tag, 'date')
+        else:
+            return
+        self._capture_depth = 1
+        self._text = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if self._container is None:
+            url = attrs.get('href')
+            if (self._is_photo_link(tag, attrs) and url
+                    and url.startswith('http')):
+                self.records.append(LinkRecord(url))
+            return
+        if not self._depth:
+            if tag == self._container and _has_class(attrs, 'im_in'):
+                self._depth = 1
+                self._reset_message()
+            return
+        if tag == self._container:
+            self._depth += 1
+        if self._is_photo_link(tag, attrs):
+            self._urls.append(attrs['href'] or '')
+        self._start_capture(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if not self._depth:
+            return
+        if self._capture is not None and tag == self._capture[0]:
+            self._capture_depth -= 1
+            if not self._capture_depth:
+                setattr(self, f'_{self._capture[1]}', ''.join(self._text))
+                self._capture = None
+        if tag == self._container:
+            self._depth -= 1
+            if not self._depth:
+                self._finish_message()
+
+    def handle_data(self, data):
+        if self._capture is not None:
+            self._text.append(data)
+
+    def _finish_message(self):
+        if not self._urls:
+            return
+        author = self._author or ''
+        date = _format_message_date(self._date or '')
+        self.records.extend(
+            LinkRecord(url, author, date) for url in self._urls if url)
+
+
+class LinkCollector:
+    """Extracts compact link records from a single html file.
+
+    Kept free of any downloader state, so it can be shipped to the
+    parse worker processes as is. In ``streaming`` mode files are read by
+    chunks and never turned into a full tree.
+    """
+    def __init__(self,
+                 streaming: bool = False,
+                 profile_dir: Optional[str] = None):
+        self._streaming = streaming
+        self._profile_dir = profile_dir
+
+    @property
+    def streaming(self):
+        return self._streaming
+
+    @staticmethod
+    def _get_image_container_and_a_filter(file):
+        if file.is_htm:
+            return 'tr', None
+        return 'div', {'class': 'download_photo_type'}
+
+    def _collect_links_from_dialog(self, file) -> List[LinkRecord]:
+        with open(file.file_path, encoding='utf-8') as f:
+            html = f.read()
+        return self._links_from_dialog_html(file, html)
+
+    def _links_from_dialog_html(self, file, html: str) -> List[LinkRecord]:
+        result = []
+        img_container, a_filter = self._get_image_container_and_a_filter(file)
+        for message in BeautifulSoup(html, 'html.parser').find_all(
+                img_container, {'class': 'im_in'}):
+            photos = message.find_all('a', a_filter, href=True)
+            if not photos:
+                continue
+            photos = [img['href'] for img in photos]
+            author = message.find('div', {
+                'class': 'im_log_author_chat_name'
+            }).text
+            str_date = message.find('a', {'class': 'im_date_link'}).text
+            date = _format_message_date(str_date)
+            for url in photos:
+                if not url:
+                    continue
+                result.append(LinkRecord(url, author, date))
+        return result
+
+    def _collect_links_from_attachment(self, file) -> List[LinkRecord]:
+        with open(file.file_path, encoding='utf-8') as f:
+            html = f.read()
+        soup = BeautifulSoup(html, 'html.parser')
+        _, a_filter = self._get_image_container_and_a_filter(file)
+        photos = soup.find_all('a', a_filter, href=True)
+        result = []
+        for photo in photos:
+            url = photo.get('href')
+            if url and url.startswith('http'):
+                result.append(LinkRecord(url))
+        return result
+
+    def iter_streaming_records(self, file) -> Iterator[LinkRecord]:
+        with open(file.file_path, encoding='utf-8') as f:
+            yield from self._iter_streaming_chunks(
+                file, iter(lambda: f.read(STREAM_CHUNK_SIZE), ''))
+
+    def _iter_streaming_chunks(self, file,
+                               chunks: Iterable[str]) -> Iterator[LinkRecord]:
+        img_container, a_filter = self._get_image_container_and_a_filter(file)
+        if file.file_type is not HtmlTypeDoc.DIALOG:
+            img_container = None
+        parser = StreamingLinkParser(img_container,
+                                     a_filter and a_filter['class'])
+        for chunk in chunks:
+            parser.feed(chunk)
+            while parser.records:
+                yield parser.records.popleft()
+        parser.close()
+        yield from parser.records
+
+    def split_dialog(self, html_file: HtmlFile,
+                     part_count: int) -> List[Tuple[int, int]]:
+        """Byte ranges of the file cut right before ``im_in`` messages.
+
+        The file is memory-mapped, only the cut points are searched.
+        """
+        img_container, _ = self._get_image_container_and_a_filter(html_file)
+        message_start = re.compile(rb'<' + img_container.encode() +
+                                   rb'\s[^>]*class="(?:[^"]*\s)?im_in[\s"]')
+        with open(html_file.file_path, 'rb') as file, \
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            size = len(data)
+            bounds = [0]
+            for part in range(1, part_count):
+                match = message_start.search(
+                    data, max(bounds[-1] + 1, size * part // part_count))
+                if match is None:
+                    break
+                bounds.append(match.start())
+        bounds.append(size)
+        return list(zip(bounds, bounds[1:]))
+
+    def collect_range(self, html_file: HtmlFile, start: int,
+                      end: int) -> List[LinkRecord]:
+        """Records of the messages in a ``split_dialog`` range."""
+        with open(html_file.file_path, 'rb') as file, \
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            html = data[start:end].decode('utf-8')
+        # same newlines as the files opened in text mode
+        html = html.replace('\r\n', '\n').replace('\r', '\n')
+        if self._streaming:
+            return list(
+                self._iter_streaming_chunks(html_file, (
+                    html[offset:offset + STREAM_CHUNK_SIZE]
+                    for offset in range(0, len(html), STREAM_CHUNK_SIZE))))
+        return self._links_from_dialog_html(html_file, html)
+
+    def collect(self, html_file: HtmlFile) -> List[LinkRecord]:
+        if self._streaming:
+            return list(self.iter_streaming_records(html_file))
+        if html_file.file_type is HtmlTypeDoc.DIALOG:
+            return self._collect_links_from_dialog(html_file)
+        if html_file.file_type is HtmlTypeDoc.PHOTOS_ONLY:
+            return self._collect_links_from_attachment(html_file)
+        raise NotImplementedError
+
+    def _collect_profiled(self, task: 'ParseTask') -> List[LinkRecord]:
+        profiler = cProfile.Profile()
+        records = profiler.runcall(self._collect_task_records, task)
+        name = re.sub(r'\W+', '_', task.html_file.file_path).strip('_')
+        if task.part_count > 1:
+            name = f'{name}.part{task.part}'
+        profiler.dump_stats(
+            os.path.join(self._profile_dir, f'{name}.{os.getpid()}.prof'))
+        return records
+
+    def _collect_task_records(self, task: 'ParseTask') -> List[LinkRecord]:
+        if task.part_count == 1:
+            return self.collect(task.html_file)
+        return self.collect_range(task.html_file, task.start, task.end)
+
+    def collect_task(self, task: 'ParseTask') -> \
+            Tuple['ParseTask', List[LinkRecord], float]:
+        """(task, records, parse seconds), runs in the worker processes."""
+        started = time.perf_counter()
+        if self._profile_dir:
+            records = self._collect_profiled(task)
+        else:
+            records = self._collect_task_records(task)
+        return task, records, time.perf_counter() - started
+
+
+class ParseTask(NamedTuple):
+    """A whole html file or one byte range of a split dialog."""
+    html_file: HtmlFile
+    part: int = 0
+    part_count: int = 1
+    start: int = 0
+    end: int = 0
+
+
+class ParseCache:
+    """SQLite store of link records per html file.
+
+    A dump is immutable once written, so a file with the same path, size,
+    mtime and type is never parsed twice. Used by one thread at a time,
+    but not always the one that opened it (pipelined mode).
+    """
+    def __init__(self, db_path: str):
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS parsed_files ('
+                                 'path TEXT PRIMARY KEY, '
+                                 'identity TEXT NOT NULL, '
+                                 'records TEXT NOT NULL)')
+        self._connection.commit()
+
+    @staticmethod
+    def _identity(html_file: HtmlFile) -> str:
+        stat = os.stat(html_file.file_path)
+        return (f'{PARSE_CACHE_VERSION}:{html_file.file_type.name}:'
+                f'{stat.st_size}:{stat.st_mtime_ns}')
+
+    def get(self, html_file: HtmlFile) -> Optional[List[LinkRecord]]:
+        row = self._connection.execute(
+            'SELECT identity, records FROM parsed_files WHERE path = ?',
+            (html_file.file_path, )).fetchone()
+        if row is None or row[0] != self._identity(html_file):
+            return None
+        return [LinkRecord(*record) for record in json.loads(row[1])]
+
+    def put(self, html_file: HtmlFile, records: List[LinkRecord]):
+        self._connection.execute(
+            'INSERT OR REPLACE INTO parsed_files (path, identity, records) '
+            'VALUES (?, ?, ?)',
+            (html_file.file_path, self._identity(html_file),
+             json.dumps(records, ensure_ascii=False)))
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+
+class Parser:
+    def __init__(self,
+                 file_checker: FileChecker,
+                 download_manager: Downloader,
+                 *,
+                 include_attachment_girls: bool = False,
+                 include_attachment_boys: bool = False,
+                 include_chat_with_girls: bool = False,
+                 include_chat_with_boys: bool = False,
+                 manual_file=False,
+                 streaming_parse: bool = False,
+                 profile_dir: Optional[str] = None,
+                 discovery_workers: int = DISCOVERY_WORKERS,
+                 attachment_path_name: str = 'Вложения',
+                 chat_path_name: str = 'Диалоги',
+                 girls_dir: str = 'Девочки',
+                 boys_dir: str = 'Парни'):
+        self._file_checker = file_checker
+        self._download_manager = download_manager
+        self._link_collector = LinkCollector(streaming_parse, profile_dir)
+        self._include_attachment_girls = include_attachment_girls
+        self._include_attachment_boys = include_attachment_boys
+        self._include_chat_with_girls = include_chat_with_girls
+        self._include_chat_with_boys = include_chat_with_boys
+        if not any((include_attachment_girls, include_chat_with_girls,
+                    include_attachment_boys,
+                    include_chat_with_boys)) and not manual_file:
+            raise ValueError(
+                'No sources type (attach or/and dialog) to download!')
+        self._mode = (ParserMode.TARGET_FILE
+                      if manual_file else ParserMode.AUTO_SEARCH)
+        self._attachment_path_name = attachment_path_name
+        self._chat_path_name = chat_path_name
+        self._girls_dir = girls_dir
+        self._boys_dir = boys_dir
+        self._discovery_workers = discovery_workers
+
+    @property
+    def parser_mode(self):
+        return self._mode
+
+    @property
+    def link_collector(self):
+        return self._link_collector
+
+    def _subtree_type(self, name: str,
+                      root_type: Optional[HtmlTypeDoc]) -> \
+            Optional[HtmlTypeDoc]:
+        if root_type is HtmlTypeDoc.PHOTOS_ONLY:
+            girls, boys = (self._include_attachment_girls,
+                           self._include_attachment_boys)
+        elif root_type is HtmlTypeDoc.DIALOG:
+            girls, boys = (self._include_chat_with_girls,
+                           self._include_chat_with_boys)
+        else:
+            return None
+        if (name == self._girls_dir and girls) or \
+                (name == self._boys_dir and boys):
+            return root_type
+        return None
+
+    def _root_type(self, name: str, chat_dir: str) -> Optional[HtmlTypeDoc]:
+        if name == self._attachment_path_name:
+            if any((self._include_attachment_boys,
+                    self._include_attachment_girls)):
+                return HtmlTypeDoc.PHOTOS_ONLY
+        elif name == chat_dir:
+            if any((self._include_chat_with_boys,
+                    self._include_chat_with_girls)):
+                return HtmlTypeDoc.DIALOG
+        return None
+
+    def _scan_dir(self, dir_path: str, context: DirContext, chat_dir: str):
+        """One scandir pass: matched files and the contexts of subdirs.
+
+        ``context`` is (files type of the subtree, type of the
+        attachment/dialog root this dir is). A subtree type is inherited
+        by every nested dir.
+        """
+        files_type, root_type = context
+        files, subdirs = [], []
+        try:
+            entries = os.scandir(dir_path)
+        except OSError as err:
+            print(f'Can\'t scan {dir_path}: {err}')
+            return files, subdirs
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append((entry.path,
+                                    (files_type or self._subtree_type(
+                                        entry.name, root_type),
+                                     self._root_type(entry.name,
+                                                     chat_dir))))
+                elif files_type is not None and \
+                        self._file_checker.check_by_file_name(
+                            entry.name) is files_type:
+                    files.append(HtmlFile(entry.path, files_type))
+        return files, subdirs
+
+    def _chat_dir(self, root_path: str) -> str:
+        if self._chat_path_name == ".":
+            return os.path.basename(root_path)
+        return self._chat_path_name
+
+    def html_file_of(self, root_path: str,
+                     file_path: str) -> Optional[HtmlFile]:
+        """The file as ``search_html(root_path)`` would find it, or None."""
+        chat_dir = self._chat_dir(root_path)
+        files_type, root_type = None, self._root_type(
+            os.path.basename(root_path), chat_dir)
+        rel_dir = os.path.relpath(os.path.dirname(file_path), root_path)
+        for name in rel_dir.split(os.sep):
+            if name == os.curdir:
+                continue
+            files_type, root_type = (files_type or self._subtree_type(
+                name, root_type), self._root_type(name, chat_dir))
+        if files_type is not None and self._file_checker.check_by_file_name(
+                os.path.basename(file_path)) is files_type:
+            return HtmlFile(file_path, files_type)
+        return None
+
+    def search_html(self, root_path_for_search: str):
+        """Walk the dump once, sibling subtrees are scanned in parallel."""
+        chat_dir = self._chat_dir(root_path_for_search)
+        root_context = (None,
+                        self._root_type(
+                            os.path.basename(root_path_for_search),
+                            chat_dir))
+        files = []
+        with ThreadPoolExecutor(self._discovery_workers) as executor:
+            pending = {
+                executor.submit(self._scan_dir, root_path_for_search,
+                                root_context, chat_dir)
+            }
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dir_files, subdirs = future.result()
+                    files.extend(dir_files)
+                    pending.update(
+                        executor.submit(self._scan_dir, path, context,
+                                        chat_dir)
+                        for path, context in subdirs)
+        files.sort(key=lambda file: file.file_path)
+        return files
+
+    def get_manual_file(self, file_path):
+        file_type = self._file_checker.check_by_html(file_path)
+        if file_type is None:
+            raise ValueError('Incorrect file')
+        return HtmlFile(file_path, file_type)
+
+    def images_from_records(self, file_path: str,
+                            records: List[LinkRecord]) -> List[Image]:
+        return [
+            self._download_manager.generate_image_object(
+                file_path, *record)
+            for record in self._download_manager.select_variants(records)
+        ]
@@ -0,0 +1,406 @@
+import asyncio
+import hashlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+from array import array
+from enum import Enum
+from typing import Iterator, NamedTuple, Optional, Tuple
+
+from .jobs import Image, JobIndex, JobStore, canonical_url_key
+
+
+class FsyncPolicy(Enum):
+    NONE = 'none'  # leave flushing to the OS
+    FILE = 'file'  # fsync every photo before the rename
+    FULL = 'full'  # and fsync its dir after the rename
+
+
+MANIFEST_COMMIT_EVERY = 500
+HASH_CHUNK_SIZE = 1024 * 1024
+DISK_WRITERS = 2
+DISK_QUEUE_SIZE = 64
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
+JPEG_TAIL_SIZE = 64
+
+
+class VerifyOptions(NamedTuple):
+    workers: Optional[int] = None  # cpu count
+    check_hash: bool = False
+
+
+class DownloadManifest:
+    """SQLite record of every download attempt keyed by (url, path)."""
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, db_path: str):
+        self._connection = sqlite3.connect(db_path)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS downloads ('
+                                 'url TEXT NOT NULL, '
+                                 'path TEXT NOT NULL, '
+                                 'status TEXT NOT NULL, '
+                                 'size INTEGER, '
+                                 'error TEXT, '
+                                 'updated REAL NOT NULL, '
+                                 'sha256 TEXT, '
+                                 'PRIMARY KEY (url, path))')
+        columns = [
+            row[1] for row in self._connection.execute(
+                'PRAGMA table_info(downloads)')
+        ]
+        if 'sha256' not in columns:
+            self._connection.execute(
+                'ALTER TABLE downloads ADD COLUMN sha256 TEXT')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS downloads_sha256 '
+                                 'ON downloads (sha256)')
+        self._connection.commit()
+        self._pending = 0
+
+    def status(self, img: Image) -> Optional[str]:
+        row = self._connection.execute(
+            'SELECT status FROM downloads WHERE url = ? AND path = ?',
+            (img.url, img.path)).fetchone()
+        return row[0] if row else None
+
+    def is_done(self, img: Image) -> bool:
+        return self.status(img) == self.DONE
+
+    def is_failed(self, img: Image) -> bool:
+        return self.status(img) == self.FAILED
+
+    def path_by_hash(self, sha256: str) -> Optional[str]:
+        row = self._connection.execute(
+            'SELECT path FROM downloads WHERE sha256 = ? AND status = ? '
+            'LIMIT 1', (sha256, self.DONE)).fetchone()
+        return row[0] if row else None
+
+    def _record(self, img: Image, status, size, error, sha256=None):
+        self._connection.execute(
+            'INSERT OR REPLACE INTO downloads '
+            '(url, path, status, size, error, updated, sha256) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (img.url, img.path, status, size, error, time.time(), sha256))
+        self._pending += 1
+        if self._pending >= MANIFEST_COMMIT_EVERY:
+            self.commit()
+
+    def saved(self,
+              img: Image) -> Optional[Tuple[Optional[int], Optional[str]]]:
+        """(size, sha256) recorded for a finished download, else None."""
+        return self._connection.execute(
+            'SELECT size, sha256 FROM downloads '
+            'WHERE url = ? AND path = ? AND status = ?',
+            (img.url, img.path, self.DONE)).fetchone()
+
+    def mark_done(self,
+                  img: Image,
+                  size: Optional[int],
+                  sha256: Optional[str] = None):
+        self._record(img, self.DONE, size, None, sha256)
+
+    def mark_failed(self, img: Image, error: str):
+        self._record(img, self.FAILED, None, error)
+
+    def commit(self):
+        self._connection.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self._connection.close()
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PhotoCheck(NamedTuple):
+    path: Optional[str]  # photo file or archive shard, None if not indexed
+    offset: Optional[int] = None  # of the photo data in the shard
+    size: Optional[int] = None  # of the photo in the shard
+    expected_size: Optional[int] = None
+    sha256: Optional[str] = None
+    recorded: bool = False  # done in the manifest, so it must exist
+
+
+def check_photo(check: PhotoCheck) -> Optional[str]:
+    """Why a saved photo is broken, None if it looks fine.
+
+    An absent photo is fine unless the manifest records it as done.
+    Reads only the head and the tail of the photo unless a hash is given.
+    """
+    if check.path is None:
+        return 'missing' if check.recorded else None
+    try:
+        with open(check.path, 'rb') as file:
+            start, size = check.offset or 0, check.size
+            if size is None:
+                size = os.fstat(file.fileno()).st_size
+            if check.expected_size is not None and \
+                    size != check.expected_size:
+                return f'size {size}, expected {check.expected_size}'
+            if size < len(JPEG_SOI) + len(JPEG_EOI):
+                return f'size {size}'
+            file.seek(start)
+            if file.read(len(JPEG_SOI)) != JPEG_SOI:
+                return 'no JPEG start marker'
+            tail_size = min(size, JPEG_TAIL_SIZE)
+            file.seek(start + size - tail_size)
+            if not file.read(tail_size).rstrip(b'\0').endswith(JPEG_EOI):
+                return 'no JPEG end marker (truncated)'
+            if check.sha256 is not None:
+                digest = hashlib.sha256()
+                file.seek(start)
+                left = size
+                while left:
+                    chunk = file.read(min(left, HASH_CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    left -= len(chunk)
+                if digest.hexdigest() != check.sha256:
+                    return 'sha256 mismatch'
+    except FileNotFoundError:
+        return 'missing' if check.recorded else None
+    except OSError as err:
+        return str(err)
+    return None
+
+
+def check_photo_at(item: Tuple[int, PhotoCheck]) -> \
+        Tuple[int, Optional[str]]:
+    index, check = item
+    return index, check_photo(check)
+
+
+def hardlink(source: str, target: str) -> bool:
+    """Atomically replace (or create) ``target`` with a link to source."""
+    if not os.path.isfile(source):
+        return False
+    temp_path = target + '.link'
+    try:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.exists(target) and os.path.samefile(source, target):
+            return False
+        os.link(source, temp_path)
+        os.replace(temp_path, target)
+        return True
+    except OSError as err:
+        print(f'Can\'t link {target} to {source}: {err}')
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        return False
+
+
+class Deduplicator:
+    """Avoids downloading and storing the same photo twice.
+
+    Links with the same canonical url are downloaded once and linked after
+    the run. Photos that still turn out identical by content are replaced
+    with hardlinks right after the download.
+    """
+    def __init__(self,
+                 jobs: JobStore,
+                 manifest: Optional[DownloadManifest] = None):
+        self._jobs = jobs
+        self._manifest = manifest
+        self._url_keys = JobIndex(
+            lambda index: canonical_url_key(jobs.url(index)))
+        self._hashes = {}
+        self._pending_links = array('I')  # primary, duplicate job index
+        self.linked_count = 0
+
+    def register(self, img: Image, index: int) -> bool:
+        """False if the same url is already queued for another path."""
+        primary = self._url_keys.setdefault(canonical_url_key(img.url), index)
+        if primary == index:
+            return True
+        self._pending_links.extend((primary, index))
+        return False
+
+    @property
+    def pending_links(self) -> Iterator[Tuple[str, str]]:
+        """(primary path, duplicate path) pairs to link after the run."""
+        links, jobs = self._pending_links, self._jobs
+        for pair in range(0, len(links), 2):
+            yield jobs.image(links[pair]).path, \
+                jobs.image(links[pair + 1]).path
+
+    def _known_path(self, sha256: str) -> Optional[str]:
+        path = self._hashes.get(sha256)
+        if path is None and self._manifest is not None:
+            path = self._manifest.path_by_hash(sha256)
+        return path
+
+    async def dedup_content(self, path: str) -> str:
+        loop = asyncio.get_running_loop()
+        sha256 = await loop.run_in_executor(None, file_sha256, path)
+        known_path = self._known_path(sha256)
+        if known_path is None or known_path == path:
+            self._hashes[sha256] = path
+        elif hardlink(known_path, path):
+            self.linked_count += 1
+        return sha256
+
+    def link_pending(self):
+        for primary_path, path in self.pending_links:
+            if not os.path.exists(path) and hardlink(primary_path, path):
+                self.linked_count += 1
+        del self._pending_links[:]
+
+
+class _WriteHandle:
+    __slots__ = ('path', 'file', 'error', 'queue')
+
+    def __init__(self, path: str, writer_queue: queue.SimpleQueue):
+        self.path = path
+        self.file = None
+        self.error = None
+        self.queue = writer_queue
+
+
+class DiskWriter:
+    """Write-behind disk stage, downloads don't wait for the disk.
+
+    Chunks are handed over to ``writer_count`` threads through a queue
+    bounded by ``queue_size`` operations. Every file is pinned to one
+    thread, so its chunks stay in order. Write errors are raised by
+    ``close``.
+    """
+    def __init__(self,
+                 writer_count: int = DISK_WRITERS,
+                 queue_size: int = DISK_QUEUE_SIZE,
+                 fsync: FsyncPolicy = FsyncPolicy.NONE):
+        self._queues = [queue.SimpleQueue() for _ in range(writer_count)]
+        self._queue_size = queue_size
+        self._fsync = fsync
+        self._created_dirs = set()
+        self._threads = []
+        self._slots = None
+        self._loop = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(self._queue_size)
+        self._threads = [
+            threading.Thread(target=self._run, args=(writer_queue, ),
+                             daemon=True) for writer_queue in self._queues
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    async def stop(self):
+        for writer_queue in self._queues:
+            writer_queue.put(None)
+        await asyncio.gather(*[
+            self._loop.run_in_executor(None, thread.join)
+            for thread in self._threads
+        ])
+        self._threads = []
+
+    def _run(self, writer_queue: queue.SimpleQueue):
+        while True:
+            operation = writer_queue.get()
+            if operation is None:
+                return
+            handle, func, args, future = operation
+            try:
+                func(handle, *args)
+            # pylint: disable-next=broad-exception-caught
+            except Exception as err:
+                # call() runs any function (sqlite, zip for archives): an
+                # error that killed the thread would hang its waiters, so
+                # every one is handed to the awaiting coroutine instead
+                handle.error = handle.error or err
+            self._loop.call_soon_threadsafe(self._done, handle, future)
+
+    def _done(self, handle: _WriteHandle, future: Optional[asyncio.Future]):
+        self._slots.release()
+        if future is None or future.done():
+            return
+        if handle.error is not None:
+            future.set_exception(handle.error)
+        else:
+            future.set_result(None)
+
+    async def _submit(self,
+                      handle: _WriteHandle,
+                      func,
+                      *args,
+                      wait_done=False):
+        await self._slots.acquire()
+        future = self._loop.create_future() if wait_done else None
+        handle.queue.put((handle, func, args, future))
+        if future is not None:
+            await future
+
+    def _handle(self, path: str) -> _WriteHandle:
+        return _WriteHandle(path,
+                            self._queues[hash(path) % len(self._queues)])
+
+    def _make_dirs(self, dir_path: str):
+        if dir_path not in self._created_dirs:
+            os.makedirs(dir_path, exist_ok=True)
+            self._created_dirs.add(dir_path)
+
+    def _open(self, handle: _WriteHandle, append: bool):
+        self._make_dirs(os.path.dirname(handle.path))
+        handle.file = open(handle.path, 'ab' if append else 'wb')
+
+    @staticmethod
+    def _write(handle: _WriteHandle, chunk: bytes):
+        if handle.error is None:
+            handle.file.write(chunk)
+
+    def _close(self, handle: _WriteHandle):
+        file, handle.file = handle.file, None
+        if file is None:
+            return
+        try:
+            if handle.error is None and self._fsync is not FsyncPolicy.NONE:
+                file.flush()
+                os.fsync(file.fileno())
+        finally:
+            file.close()
+
+    def _replace(self, handle: _WriteHandle, target: str):
+        os.replace(handle.path, target)
+        if self._fsync is FsyncPolicy.FULL:
+            dir_fd = os.open(os.path.dirname(target) or '.', os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    async def open(self, path: str, append=False) -> _WriteHandle:
+        handle = self._handle(path)
+        await self._submit(handle, self._open, append)
+        return handle
+
+    async def write(self, handle: _WriteHandle, chunk: bytes):
+        await self._submit(handle, self._write, chunk)
+
+    async def close(self, handle: _WriteHandle):
+        """Wait until the file is on disk (synced by the fsync policy)."""
+        await self._submit(handle, self._close, wait_done=True)
+
+    async def replace(self, path: str, target: str):
+        await self._submit(self._handle(path), self._replace, target,
+                           wait_done=True)
+
+    @staticmethod
+    def _call(_, func, *args):
+        func(*args)
+
+    async def call(self, key: str, func, *args):
+        """Run ``func(*args)`` on the thread of ``key`` and wait for it."""
+        await self._submit(self._handle(key), self._call, func, *args,
+                           wait_done=True)
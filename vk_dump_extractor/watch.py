@@ -0,0 +1,214 @@
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import time
+from typing import List, Optional, Tuple
+
+from .parsing import HtmlFile, Parser
+
+WATCH_SETTLE = 2
+WATCH_POLL_INTERVAL = 10
+WATCH_TICK = 0.5
+
+
+class Inotify:
+    """Recursive inotify watch through ctypes (Linux only).
+
+    Reports files closed after writing or moved in. Dirs that appear later
+    are watched as well and files already inside them are reported.
+    """
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32)
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._dirs = {}
+        self.overflowed = False
+
+    @classmethod
+    def create(cls) -> Optional['Inotify']:
+        try:
+            return cls()
+        except (OSError, AttributeError, TypeError) as err:
+            print(f'Inotify is not available ({err}), polling')
+            return None
+
+    def watch_tree(self, root: str,
+                   dir_path: str) -> List[Tuple[str, str]]:
+        """Watch every dir of the tree, returns (root, path) of files."""
+        files = []
+        for path, _, file_names in os.walk(dir_path):
+            wd = self._add_watch(self._fd, os.fsencode(path),
+                                 self.WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOENT:
+                    continue
+                raise OSError(err, f'Can\'t watch {path}: '
+                              f'{os.strerror(err)}')
+            self._dirs[wd] = (root, path)
+            files.extend((root, os.path.join(path, name))
+                         for name in file_names)
+        return files
+
+    def read_changes(self) -> List[Tuple[str, str]]:
+        changes = []
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return changes
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, name_size = self.EVENT_HEADER.unpack_from(
+                    data, offset)
+                offset += self.EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + name_size].rstrip(
+                    b'\0'))
+                offset += name_size
+                if mask & self.IN_Q_OVERFLOW:
+                    self.overflowed = True
+                if wd not in self._dirs or not name:
+                    continue
+                root, dir_path = self._dirs[wd]
+                path = os.path.join(dir_path, name)
+                if mask & self.IN_ISDIR:
+                    changes.extend(self.watch_tree(root, path))
+                elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                    changes.append((root, path))
+
+    def close(self):
+        os.close(self._fd)
+
+
+class DumpWatcher:
+    """Finds dump html files once the dumper has finished writing them.
+
+    A new or changed file is reported after it stays the same (size and
+    mtime) for ``settle`` seconds, a file is reported again only when it
+    changes. Inotify tells which files to look at, without it the dumps
+    are rescanned every ``poll_interval`` seconds.
+    """
+    def __init__(self,
+                 parser: Parser,
+                 roots: List[str],
+                 settle: float = WATCH_SETTLE,
+                 poll_interval: float = WATCH_POLL_INTERVAL,
+                 use_inotify: bool = True):
+        self._parser = parser
+        self._roots = roots
+        self._settle = settle
+        self._poll_interval = poll_interval
+        self._inotify = Inotify.create() if use_inotify else None
+        self._watching = False
+        self._pending = {}
+        self._reported = {}
+
+    @staticmethod
+    def _identity(path: str) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def _add_candidate(self, html_file: Optional[HtmlFile],
+                       now: float) -> bool:
+        if html_file is None:
+            return False
+        path = html_file.file_path
+        identity = self._identity(path)
+        if identity is None or identity == self._reported.get(path):
+            return False
+        pending = self._pending.get(path)
+        if pending is not None and pending[1] == identity:
+            return False
+        self._pending[path] = (html_file, identity, now)
+        return True
+
+    def _poll_inotify(self, now: float) -> Tuple[bool, bool]:
+        """(full rescan is needed, candidates changed)."""
+        changed = False
+        try:
+            if not self._watching:
+                for root in self._roots:
+                    self._inotify.watch_tree(root, root)
+                self._watching = True
+                return True, changed
+            for root, path in self._inotify.read_changes():
+                changed |= self._add_candidate(
+                    self._parser.html_file_of(root, path), now)
+        except OSError as err:
+            print(f'{err}, falling back to polling')
+            self._inotify.close()
+            self._inotify = None
+            return True, changed
+        overflowed, self._inotify.overflowed = self._inotify.overflowed, False
+        return overflowed, changed
+
+    def _tick(self, now: float, rescan: bool) -> Tuple[List[HtmlFile], bool]:
+        changed = False
+        if self._inotify is not None:
+            rescan, changed = self._poll_inotify(now)
+        if rescan:
+            for root in self._roots:
+                for html_file in self._parser.search_html(root):
+                    changed |= self._add_candidate(html_file, now)
+        ready = []
+        for path, (html_file, identity, since) in list(
+                self._pending.items()):
+            current = self._identity(path)
+            if current is None:
+                del self._pending[path]
+            elif current != identity:
+                self._pending[path] = (html_file, current, now)
+                changed = True
+            elif now - since >= self._settle:
+                del self._pending[path]
+                self._reported[path] = identity
+                ready.append(html_file)
+        return ready, changed or bool(ready)
+
+    async def changes(self, idle_exit: float = 0):
+        """Yield lists of finished files.
+
+        Runs forever or, with ``idle_exit``, until nothing changes in
+        the dumps for that many seconds.
+        """
+        loop = asyncio.get_running_loop()
+        next_rescan = last_change = time.monotonic()
+        rescan = True
+        try:
+            while True:
+                now = time.monotonic()
+                ready, changed = await loop.run_in_executor(
+                    None, self._tick, now, rescan)
+                if rescan:
+                    next_rescan = now + self._poll_interval
+                if changed:
+                    last_change = now
+                if ready:
+                    yield ready
+                elif idle_exit and not self._pending and \
+                        now - last_change >= idle_exit:
+                    return
+                await asyncio.sleep(WATCH_TICK)
+                rescan = time.monotonic() >= next_rescan
+        finally:
+            if self._inotify is not None:
+                self._inotify.close()